@@ -12,12 +12,15 @@ class MapEncoder(JSONEncoder):
         if isinstance(obj, SortedSet):
             return list(obj)
         elif isinstance(obj, DungeonMap):
-            return {
+            result = {
                 '__type__': 'DungeonMap',
                 'regions': obj.regions,
                 'connections': obj.connections,
                 'decorations': obj.decorations
             }
+            if obj.footprint is not None:
+                result['footprint'] = obj.footprint
+            return result
         elif isinstance(obj, Region):
             return {
                 '__type__': 'Region',
@@ -69,9 +72,13 @@ def map_from_dict(obj):
                           aagen.geometry.from_string(obj['polygon']),
                           Direction.named(obj['orientation']))
     elif obj['__type__'] == 'DungeonMap':
-        dungeon_map = DungeonMap()
+        footprint = None
+        if 'footprint' in obj.keys():
+            footprint = aagen.geometry.from_string(obj['footprint'])
+        dungeon_map = DungeonMap(footprint=footprint)
         for reg in obj['regions']:
-            dungeon_map.add_region(reg)
+            dungeon_map.add_region(reg, refresh=False)
+        dungeon_map.refresh_conglomerate()
         for conn in obj['connections']:
             dungeon_map.add_connection(conn)
         for dec in obj['decorations']:
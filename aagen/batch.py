@@ -0,0 +1,224 @@
+# aagen.batch - headless generation of many dungeons at once.
+#
+# Unlike the interactive bin/aagen, nothing here imports pygame or draws
+# anything, so batch runs work on servers without any display.
+
+import json
+import logging
+import multiprocessing
+import sys
+import time
+import traceback
+
+from .map import DungeonMap
+from .generator import (DungeonGenerator, Silenced, PLACEMENT_EDGES,
+                        RANDOMNESS_SEQUENTIAL, STOP_ERROR)
+from .scheduler import SCHEDULE_RANDOM
+from .frontier import FrontierExpander
+from .aajson import MapEncoder
+import aagen.geometry
+
+log = logging.getLogger(__name__)
+
+
+def parse_seeds(spec):
+    """Parse a seed specification such as "1,5,10-20" into a list of seeds.
+    Ranges are inclusive at both ends.
+    """
+    seeds = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        (first, sep, last) = part.partition("-")
+        try:
+            if sep:
+                (first, last) = (int(first), int(last))
+                if last < first:
+                    raise ValueError
+                seeds.extend(range(first, last + 1))
+            else:
+                seeds.append(int(first))
+        except ValueError:
+            raise ValueError("Invalid seed or seed range '{0}'".format(part))
+    return seeds
+
+
+def generate(seed, steps=None, regions=None, rooms=None, area=None,
+             seconds=None, placement=PLACEMENT_EDGES,
+             randomness=RANDOMNESS_SEQUENTIAL, schedule=SCHEDULE_RANDOM,
+             footprint=None, step_seconds=None, step_work=None, frontier=1,
+             jobs=1, narrate=False):
+    """Generate a single dungeon from the given seed, running until any of
+    the given stop conditions is met (see DungeonGenerator.run()) or the
+    map has no incomplete connections left to expand.
+    If a footprint polygon is given, the dungeon is confined within it.
+    Each step may be limited to the given time and work budget (see
+    DungeonGenerator.over_budget()).
+
+    With frontier > 1, up to that many connections are expanded at once
+    (see aagen.frontier), using the given number of worker processes.
+
+    Returns the tuple (dungeon_map, summary), where the summary is as
+    returned by DungeonGenerator.run(). If a step raised an exception, the
+    summary's reason is STOP_ERROR and the step is rolled back, so the map
+    is as it was after the last successful step.
+    """
+    if (steps is None and regions is None and rooms is None and
+        area is None and seconds is None):
+        raise ValueError("No stop condition given - this would never end")
+
+    dungeon_map = DungeonMap()
+    with Silenced(not narrate):
+        # Don't spend time generating maps only to discard them
+        generator = DungeonGenerator(dungeon_map, seed, placement=placement,
+                                     randomness=randomness,
+                                     schedule=schedule, footprint=footprint,
+                                     reset=False, step_seconds=step_seconds,
+                                     step_work=step_work)
+    expander = None
+    if frontier > 1:
+        expander = FrontierExpander(generator, frontier, jobs)
+    try:
+        with Silenced(not narrate):
+            summary = generator.run(steps=steps, regions=regions,
+                                    rooms=rooms, area=area, seconds=seconds,
+                                    expander=expander)
+    finally:
+        if expander is not None:
+            expander.close()
+    dungeon_map.flush()
+    return (dungeon_map, summary)
+
+
+def save(dungeon_map, path):
+    """Write the given map to the given file in .aamap format"""
+    with open(path, 'w') as f:
+        json.dump(dungeon_map, f, cls=MapEncoder, indent=2, sort_keys=True)
+
+
+def generate_seed(seed, output="dungeon_{seed}.aamap", steps=None,
+                  regions=None, rooms=None, area=None, seconds=None,
+                  placement=PLACEMENT_EDGES,
+                  randomness=RANDOMNESS_SEQUENTIAL, schedule=SCHEDULE_RANDOM,
+                  footprint=None, step_seconds=None, step_work=None,
+                  frontier=1, jobs=1, narrate=False):
+    """Generate and save the dungeon for a single seed of a batch.
+
+    Returns a dict summarizing the result. If the output is "-", the map
+    itself is returned (as a string of JSON) under 'map' instead of being
+    saved. Any failure is reported as a traceback under 'error'.
+    """
+    start = time.time()
+    result = {'seed': seed, 'steps': 0, 'regions': 0, 'rooms': 0, 'area': 0,
+              'degraded': 0, 'reason': STOP_ERROR, 'error': None, 'output': None,
+              'map': None}
+    try:
+        (dungeon_map, summary) = generate(
+            seed, steps=steps, regions=regions, rooms=rooms, area=area,
+            seconds=seconds, placement=placement, randomness=randomness,
+            schedule=schedule, footprint=footprint,
+            step_seconds=step_seconds, step_work=step_work,
+            frontier=frontier, jobs=jobs, narrate=narrate)
+        result.update(summary)
+        if output == "-":
+            result['map'] = json.dumps(dungeon_map, cls=MapEncoder,
+                                       sort_keys=True)
+        else:
+            result['output'] = output.format(seed=seed)
+            save(dungeon_map, result['output'])
+    except Exception:
+        result['reason'] = STOP_ERROR
+        result['error'] = traceback.format_exc()
+    result['time'] = time.time() - start
+    return result
+
+
+# Options for generate_seed() in each worker process of a parallel batch
+worker_options = {}
+
+
+def init_worker(options, *settings):
+    """Prepare a worker process for a parallel batch with the given
+    generate_seed() options and settings (see aagen.geometry.init_worker())
+    """
+    worker_options.update(options)
+    aagen.geometry.init_worker(*settings)
+
+
+def worker_generate_seed(seed):
+    return generate_seed(seed, **worker_options)
+
+
+def run_batch(seeds, output="dungeon_{seed}.aamap", steps=None, regions=None,
+              rooms=None, area=None, seconds=None, placement=PLACEMENT_EDGES,
+              randomness=RANDOMNESS_SEQUENTIAL, schedule=SCHEDULE_RANDOM,
+              footprint=None, step_seconds=None, step_work=None, frontier=1,
+              narrate=False, report=None, jobs=1):
+    """Generate one dungeon for each of the given seeds, saving each one
+    according to the output template (with "{seed}" replaced by the seed).
+    If the output is "-", the maps are instead written to standard output,
+    one JSON document per line, and the per-seed summary goes to stderr
+    (rather than to the given report stream or stdout).
+
+    With jobs > 1, the dungeons are generated in that many worker processes,
+    but are still written and reported in the order of the given seeds.
+    The generator's commentary is only narrated when running a single job.
+    With frontier > 1, the dungeons are instead generated one at a time, each
+    expanding up to that many connections at once in the worker processes.
+
+    Returns the number of seeds that failed with an error.
+    """
+    if output == "-":
+        # Keep stdout clean for the maps themselves
+        report = sys.stderr
+        narrate = False
+    elif report is None:
+        report = sys.stdout
+    options = {'output': output, 'steps': steps, 'regions': regions,
+               'rooms': rooms, 'area': area, 'seconds': seconds,
+               'placement': placement,
+               'randomness': randomness, 'schedule': schedule,
+               'footprint': footprint, 'step_seconds': step_seconds,
+               'step_work': step_work}
+
+    pool = None
+    if frontier > 1:
+        results = (generate_seed(seed, frontier=frontier, jobs=jobs,
+                                 narrate=narrate, **options)
+                   for seed in seeds)
+    elif jobs > 1:
+        pool = multiprocessing.Pool(
+            jobs, init_worker,
+            (options,) + aagen.geometry.worker_settings())
+        # imap() hands back the results in order as they become available
+        results = pool.imap(worker_generate_seed, seeds, chunksize=1)
+    else:
+        results = (generate_seed(seed, narrate=narrate, **options)
+                   for seed in seeds)
+
+    failures = 0
+    try:
+        for result in results:
+            if result['map'] is not None:
+                sys.stdout.write(result['map'] + "\n")
+                sys.stdout.flush()
+            report.write("Seed {seed}: {steps} steps, {regions} regions "
+                         "({rooms} rooms), {area:.0f} square feet, "
+                         "stopped ({reason}) "
+                         "after {time:.2f}s{degraded_steps} -> {destination}\n"
+                         .format(destination=(result['output'] or "stdout"),
+                                 degraded_steps=(
+                                     ", {0} steps degraded"
+                                     .format(result['degraded'])
+                                     if result['degraded'] else ""),
+                                 **result))
+            if result['error'] is not None:
+                failures += 1
+                report.write(result['error'])
+            report.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failures
@@ -0,0 +1,348 @@
+# aagen.cave - procedurally generated cave shapes.
+#
+# A cave is grown on a grid of CELL x CELL squares by a cellular automaton:
+# we start from random noise and repeatedly let each cell take on the majority
+# state of its 3x3 neighborhood, so that the noise coalesces into smooth-edged
+# caverns. The largest cavern is then traced (by marching squares through the
+# cell centers) into an octilinear polygon for use as a room shape.
+#
+# NumPy is used for the automaton, for finding the largest cavern and for
+# tracing it if available; the pure-Python fallback produces exactly the same
+# caves, just more slowly.
+
+import logging
+import math
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import aagen.geometry
+
+log = logging.getLogger(__name__)
+
+CELL = 10
+"""Size of a grid cell, in feet. The outline is traced through the cell
+centers, so with 10' cells every vertex of a traced cave lies on the 5' grid
+(until the cave is scaled to the exact area requested)."""
+
+CAVE_FILL = 0.45
+"""Fraction of the initial grid that starts out as rock"""
+
+CAVE_SMOOTHING = 4
+"""Number of automaton steps used to smooth out the initial noise"""
+
+CAVE_VERTEX_LIMIT = 48
+"""Maximum number of vertices in a cave polygon; caves with more detail than
+this are traced again at a coarser resolution."""
+
+CAVE_ATTEMPTS = 16
+"""Maximum number of caves to grow when trying to match the requested area"""
+
+CAVE_TOLERANCE = 0.2
+"""Fraction of the requested area by which a cave may miss it and still be
+accepted (to then be stretched or shrunk to fit)"""
+
+
+def random_grid(rows, cols, fill=CAVE_FILL, rng=random):
+    """Construct a rows x cols grid (as a list of lists of booleans) where each
+    cell is rock (True) with probability fill and the outer border is all rock.
+    """
+    grid = []
+    for r in range(rows):
+        row = []
+        for c in range(cols):
+            # Always consume a random number so that the sequence doesn't
+            # depend on the grid border
+            rock = rng.random() < fill
+            row.append(rock or r in (0, rows - 1) or c in (0, cols - 1))
+        grid.append(row)
+    return grid
+
+
+def smooth(grid, steps=CAVE_SMOOTHING):
+    """Apply the given number of steps of the "4-5" cave automaton to the grid:
+    a cell becomes rock if at least 5 of the 9 cells in its 3x3 neighborhood
+    (counting anything beyond the grid as rock) are rock, and open otherwise.
+    The outer border of the grid always remains rock.
+    """
+    if steps <= 0:
+        return grid
+    if numpy is not None:
+        rock = numpy.array(grid, dtype=bool)
+        (rows, cols) = rock.shape
+        for _ in range(steps):
+            padded = numpy.pad(rock, 1, 'constant', constant_values=True)
+            padded = padded.astype(numpy.uint8)
+            counts = numpy.zeros((rows, cols), dtype=numpy.uint8)
+            for dr in range(3):
+                for dc in range(3):
+                    counts += padded[dr:dr + rows, dc:dc + cols]
+            rock = counts >= 5
+            rock[0, :] = rock[-1, :] = True
+            rock[:, 0] = rock[:, -1] = True
+        return rock.tolist()
+
+    rows = len(grid)
+    cols = len(grid[0])
+    for _ in range(steps):
+        new_grid = []
+        for r in range(rows):
+            new_row = []
+            for c in range(cols):
+                if r in (0, rows - 1) or c in (0, cols - 1):
+                    new_row.append(True)
+                    continue
+                count = 0
+                for rr in (r - 1, r, r + 1):
+                    row = grid[rr]
+                    count += row[c - 1] + row[c] + row[c + 1]
+                new_row.append(count >= 5)
+            new_grid.append(new_row)
+        grid = new_grid
+    return grid
+
+
+def flood(grid, start, value, neighbors):
+    """Find the set of (r, c) cells reachable from start through cells whose
+    grid value equals the given value, moving by the given neighbor offsets.
+    """
+    rows = len(grid)
+    cols = len(grid[0])
+    found = set([start])
+    queue = [start]
+    while queue:
+        (r, c) = queue.pop()
+        for (dr, dc) in neighbors:
+            (rr, cc) = (r + dr, c + dc)
+            if (0 <= rr < rows and 0 <= cc < cols and
+                    (rr, cc) not in found and grid[rr][cc] == value):
+                found.add((rr, cc))
+                queue.append((rr, cc))
+    return found
+
+
+ORTHOGONAL = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+ALL_AROUND = ORTHOGONAL + [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+
+def label(cells, neighbors):
+    """Label each True cell of the given NumPy array of booleans with the
+    smallest (row-major) index of any cell it is connected to through True
+    cells, moving by the given neighbor offsets. False cells are labeled
+    with the number of cells in the array.
+    """
+    (rows, cols) = cells.shape
+    size = rows * cols
+    labels = numpy.where(cells, numpy.arange(size).reshape(rows, cols), size)
+    padded = numpy.empty((rows + 2, cols + 2), dtype=labels.dtype)
+    padded.fill(size)
+    while True:
+        padded[1:-1, 1:-1] = labels
+        new = labels
+        for (dr, dc) in neighbors:
+            new = numpy.minimum(new, padded[1 + dr:1 + dr + rows,
+                                            1 + dc:1 + dc + cols])
+        new[~cells] = size
+        # Each label is the index of a cell whose own label may be smaller
+        # still, so follow these links to spread labels across long caverns
+        # in far fewer passes
+        flat = new.ravel()
+        found = flat < size
+        while True:
+            jumped = flat[flat[found]]
+            if (jumped == flat[found]).all():
+                break
+            flat[found] = jumped
+        if (new == labels).all():
+            return labels
+        labels = new
+
+
+def largest_cavern(grid):
+    """Get the largest (orthogonally connected) open area of the given rock
+    grid, with any islands of rock inside it filled in, as a grid of booleans
+    where True means open. Returns None if the grid has no open cells.
+    """
+    if numpy is not None:
+        cavern = ~numpy.array(grid, dtype=bool)
+        if not cavern.any():
+            return None
+        labels = label(cavern, ORTHOGONAL)
+        # Ties go to the cavern found first, as they do below
+        cavern = labels == numpy.bincount(labels[cavern]).argmax()
+        cavern = numpy.pad(cavern, 1, 'constant', constant_values=False)
+        # The padding's corner cell has index 0
+        return (label(~cavern, ALL_AROUND) != 0).tolist()
+
+    rows = len(grid)
+    cols = len(grid[0])
+    seen = set()
+    best = set()
+    for r in range(rows):
+        for c in range(cols):
+            if grid[r][c] or (r, c) in seen:
+                continue
+            cavern = flood(grid, (r, c), False, ORTHOGONAL)
+            seen |= cavern
+            if len(cavern) > len(best):
+                best = cavern
+    if not best:
+        return None
+
+    # Pad the cavern with a border of rock, then anything that can't be
+    # reached from that border is enclosed by the cavern and becomes part of it
+    mask = [[(r - 1, c - 1) in best for c in range(cols + 2)]
+            for r in range(rows + 2)]
+    outside = flood(mask, (0, 0), False, ALL_AROUND)
+    return [[(r, c) not in outside for c in range(cols + 2)]
+            for r in range(rows + 2)]
+
+
+def coarsen(mask):
+    """Halve the resolution of the given open/rock mask - each 2x2 block of
+    cells becomes open if at least half of it was open.
+    """
+    rows = (len(mask) + 1) // 2
+    cols = (len(mask[0]) + 1) // 2
+    if numpy is not None:
+        cells = numpy.zeros((2 * rows, 2 * cols), dtype=numpy.uint8)
+        cells[:len(mask), :len(mask[0])] = mask
+        counts = (cells[0::2, 0::2] + cells[0::2, 1::2] +
+                  cells[1::2, 0::2] + cells[1::2, 1::2])
+        return (counts < 2).tolist()
+
+    grid = []
+    for r in range(rows):
+        row = []
+        for c in range(cols):
+            count = 0
+            for rr in (2 * r, 2 * r + 1):
+                for cc in (2 * c, 2 * c + 1):
+                    if rr < len(mask) and cc < len(mask[0]) and mask[rr][cc]:
+                        count += 1
+            row.append(count < 2)
+        grid.append(row)
+    return grid
+
+
+def trace(mask, cell=CELL):
+    """Trace the outline of the open cells in the given mask into a
+    counterclockwise ring of coordinates, by marching squares through the
+    cell centers. Cells that touch only diagonally are treated as separate.
+
+    The mask must contain a single orthogonally connected open area with no
+    holes, surrounded by a border of rock.
+    """
+    rows = len(mask)
+    cols = len(mask[0])
+    # Only squares with both open and rock corners have any outline in them
+    if numpy is not None:
+        cells = numpy.array(mask, dtype=numpy.uint8)
+        counts = (cells[:-1, :-1] + cells[:-1, 1:] +
+                  cells[1:, 1:] + cells[1:, :-1])
+        squares = numpy.argwhere((counts > 0) & (counts < 4)).tolist()
+    else:
+        squares = [(r, c) for r in range(rows - 1) for c in range(cols - 1)]
+    # Map of segment start point to end point, with coordinates doubled
+    # so that they are all integers
+    segments = {}
+    for (r, c) in squares:
+        # Corners and edges of this square in counterclockwise order
+        state = [mask[r][c], mask[r][c + 1],
+                 mask[r + 1][c + 1], mask[r + 1][c]]
+        if all(state) or not any(state):
+            continue
+        points = [(2 * c + 1, 2 * r), (2 * c + 2, 2 * r + 1),
+                  (2 * c + 1, 2 * r + 2), (2 * c, 2 * r + 1)]
+        for k in range(4):
+            if not state[k] or state[(k + 1) % 4]:
+                continue
+            # Edge k goes from open to rock, so the outline runs from here
+            # back to where the open area began (clockwise from here)
+            j = k - 1
+            while state[j % 4]:
+                j -= 1
+            segments[points[k]] = points[j % 4]
+
+    start = min(segments)
+    ring = [start]
+    point = segments[start]
+    while point != start:
+        ring.append(point)
+        point = segments[point]
+
+    # Drop all points that lie along a straight stretch of the outline
+    corners = []
+    for i in range(len(ring)):
+        (x0, y0) = ring[i - 1]
+        (x1, y1) = ring[i]
+        (x2, y2) = ring[(i + 1) % len(ring)]
+        if (x1 - x0, y1 - y0) != (x2 - x1, y2 - y1):
+            corners.append(((x1 + 1) * cell / 2.0, (y1 + 1) * cell / 2.0))
+    return corners
+
+
+def cave(area, smoothing=CAVE_SMOOTHING, vertex_limit=CAVE_VERTEX_LIMIT,
+         rng=random):
+    """Construct a cave-like polygon of the requested area."""
+    cells = float(area) / (CELL * CELL)
+    # How much of the grid the cave ends up covering depends on the size of
+    # the grid (and on how much it had to be coarsened), so start from a
+    # guess of 40% and size each new grid by the average coverage so far
+    coverage = []
+    best = None
+    for _ in range(CAVE_ATTEMPTS):
+        fraction = sum(coverage) / len(coverage) if coverage else 0.4
+        if fraction > 0:
+            interior = max(int(round(math.sqrt(cells / fraction))), 2)
+        else:
+            # Nothing but solid rock so far - try a bigger grid
+            interior += 1
+        side = interior + 2
+        grid = smooth(random_grid(side, side, rng=rng), smoothing)
+        mask = largest_cavern(grid)
+        if mask is None:
+            coverage.append(0.0)
+            continue
+        cell = CELL
+        coords = trace(mask, cell)
+        while len(coords) > vertex_limit:
+            coarse = largest_cavern(coarsen(mask))
+            if coarse is None:
+                break
+            (mask, cell) = (coarse, cell * 2)
+            coords = trace(mask, cell)
+        poly = aagen.geometry.polygon(coords)
+        log.debug("Grew a cave of area {0} (target {1}) from a {2}x{2} grid"
+                  .format(poly.area, area, side))
+        coverage.append(poly.area / (interior * interior * CELL * CELL))
+        if best is None or abs(poly.area - area) < abs(best.area - area):
+            best = poly
+        if abs(poly.area - area) <= CAVE_TOLERANCE * area:
+            break
+    if best is None:
+        return None
+    # Small caves in particular only come in a few sizes, as each cell is
+    # a sizable fraction of the whole, so stretch the closest one to fit
+    scale = math.sqrt(area / best.area)
+    return aagen.geometry.polygon([(x * scale, y * scale)
+                                   for (x, y) in best.exterior.coords])
+
+
+def cave_list(area, smoothing=CAVE_SMOOTHING, rotate=True, rng=random):
+    """Returns the list of possible cave shapes (each orientation of a single
+    randomly generated cave) with approximately the requested area.
+    """
+    shape = cave(area, smoothing=smoothing, rng=rng)
+    if not rotate:
+        return [shape]
+    shapes = [shape]
+    coords = list(shape.exterior.coords)
+    for _ in range(3):
+        # Rotate by exactly 90 degrees to keep the coordinates on the grid
+        coords = [(-y, x) for (x, y) in coords]
+        shapes.append(aagen.geometry.polygon(coords))
+    return shapes
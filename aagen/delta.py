@@ -0,0 +1,206 @@
+# aagen.delta - describing how a DungeonMap changes from step to step.
+#
+# Rather than inspecting (or re-serializing) the whole map after each step of
+# the generator, a consumer such as a renderer, a network client or a journal
+# can follow DungeonGenerator.iter_steps(), which yields a StepDelta for each
+# step: the Regions, Connections and Decorations added, the Connections whose
+# kind changed, the Regions that grew, and the rolls that were made.
+# Every element is identified by its ID, so a copy of the map can be kept up
+# to date by applying each delta to it in turn.
+
+import itertools
+
+from .map import Region, Connection, Decoration
+from aagen.direction import Direction
+import aagen.geometry
+
+
+def combined_bounds(bounds_list):
+    """Get the overall bounds of the given list of bounds, or None if empty"""
+    if not bounds_list:
+        return None
+    return (min(b[0] for b in bounds_list), min(b[1] for b in bounds_list),
+            max(b[2] for b in bounds_list), max(b[3] for b in bounds_list))
+
+
+def changes_since(dungeon_map, first_id, kinds, polygons):
+    """Describe, as plain data, everything added to the given map since it
+    assigned the given element ID, and any changes to the kinds of existing
+    Connections or the shapes of existing Regions (compared to the given dicts
+    of each element's kind or polygon by ID).
+    """
+    changes = {'regions': [], 'connections': [], 'decorations': [],
+               'kinds': [], 'polygons': []}
+    bounds = []
+    for region in dungeon_map.regions:
+        if region.id >= first_id:
+            changes['regions'].append(
+                (region.id, region.kind, region.polygon,
+                 [conn.id for conn in region.connections]))
+            bounds.append(region.bounds)
+            for dec in region.decorations:
+                changes['decorations'].append(
+                    (dec.id, dec.kind, dec.polygon, dec.orientation.name,
+                     region.id))
+        elif region.polygon is not polygons[region.id]:
+            changes['polygons'].append((region.id, region.polygon))
+            bounds.append(region.bounds)
+    for conn in dungeon_map.connections:
+        if conn.id >= first_id:
+            changes['connections'].append(
+                (conn.id, conn.kind, conn.line, conn.direction.name,
+                 conn.polygon, [region.id for region in conn.regions]))
+            bounds.append(conn.bounds)
+        elif conn.kind != kinds[conn.id]:
+            changes['kinds'].append((conn.id, conn.kind))
+            bounds.append(conn.bounds)
+    changes['bounds'] = combined_bounds(bounds)
+    return changes
+
+
+def apply_changes(dungeon_map, changes, keep_ids=False):
+    """Apply the given changes (see changes_since()) to the map.
+    New elements are numbered by the map, unless keep_ids is set, in which
+    case each keeps the ID it has in the changes (as when keeping a copy
+    of another map up to date).
+    """
+    elements = dict((element.id, element) for element in
+                    itertools.chain(dungeon_map.regions,
+                                    dungeon_map.connections))
+    with dungeon_map.activate():
+        # Construct the new elements in the same order as they were
+        # originally constructed, so that they are numbered the same way
+        new = sorted(
+            [(entry[0], Region, entry) for entry in changes['regions']] +
+            [(entry[0], Connection, entry)
+             for entry in changes['connections']] +
+            [(entry[0], Decoration, entry)
+             for entry in changes['decorations']],
+            key=lambda item: item[0])
+        for (element_id, cls, entry) in new:
+            if cls == Region:
+                elements[element_id] = Region(entry[1], entry[2])
+            elif cls == Connection:
+                conn = Connection(entry[1], entry[2],
+                                  dir=Direction.named(entry[3]),
+                                  polygon=entry[4])
+                conn.direction = Direction.named(entry[3])
+                elements[element_id] = conn
+            else:
+                elements[element_id] = Decoration(entry[1], entry[2],
+                                                  Direction.named(entry[3]))
+            if keep_ids:
+                elements[element_id].id = element_id
+                dungeon_map.claim_element_id(elements[element_id])
+
+        for (dec_id, _, _, _, region_id) in changes['decorations']:
+            elements[region_id].add_decoration(elements[dec_id])
+        for (conn_id, kind) in changes['kinds']:
+            elements[conn_id].set_kind(kind)
+        for (region_id, polygon) in changes['polygons']:
+            elements[region_id].polygon = polygon
+
+        # Add the new regions before linking them to anything, so that the
+        # map only needs refreshing once for all of the new and changed regions
+        for (region_id, _, _, _) in changes['regions']:
+            dungeon_map.add_region(elements[region_id], refresh=False)
+        changed = [elements[entry[0]] for entry in
+                   changes['polygons'] + changes['regions']]
+        if changed:
+            dungeon_map.refresh_conglomerate(changed)
+
+        for (region_id, _, _, conn_ids) in changes['regions']:
+            for conn_id in conn_ids:
+                elements[region_id].add_connection(elements[conn_id])
+        for (conn_id, _, _, _, _, region_ids) in changes['connections']:
+            for region_id in region_ids:
+                elements[conn_id].add_region(elements[region_id])
+        for (conn_id, _, _, _, _, _) in changes['connections']:
+            dungeon_map.add_connection(elements[conn_id])
+
+
+class StepDelta(object):
+    """The changes made to a DungeonMap by a single step of the generator"""
+
+    def __init__(self, step, connection_id, changes, rolls, reset=False):
+        self.step = step
+        # ID of the Connection that was expanded, if any
+        self.connection_id = connection_id
+        # Whether the map was discarded and started over, in which case the
+        # changes describe the whole of the new map
+        self.reset = reset
+        # Lists of plain data, as described by changes_since()
+        self.regions = changes['regions']
+        self.connections = changes['connections']
+        self.decorations = changes['decorations']
+        self.kinds = changes['kinds']
+        self.polygons = changes['polygons']
+        self.bounds = changes['bounds']
+        # (roll, description) for each roll made during the step
+        self.rolls = list(rolls)
+
+
+    @classmethod
+    def of_map(cls, dungeon_map, step=0, rolls=()):
+        """Describe the whole of the given map, as if it had just been
+        generated from scratch"""
+        return cls(step, None, changes_since(dungeon_map, 0, {}, {}), rolls,
+                   reset=True)
+
+
+    def __repr__(self):
+        return ("<StepDelta {0}: {1} regions, {2} connections and "
+                "{3} decorations added, {4} connections changed, "
+                "{5} regions grown{6}>"
+                .format(self.step, len(self.regions), len(self.connections),
+                        len(self.decorations), len(self.kinds),
+                        len(self.polygons), " (reset)" if self.reset else ""))
+
+
+    def changes(self):
+        return {'regions': self.regions, 'connections': self.connections,
+                'decorations': self.decorations, 'kinds': self.kinds,
+                'polygons': self.polygons, 'bounds': self.bounds}
+
+
+    def apply(self, dungeon_map):
+        """Bring the given copy of the map up to date with this step"""
+        if self.reset:
+            dungeon_map.__init__(footprint=dungeon_map.footprint)
+        apply_changes(dungeon_map, self.changes(), keep_ids=True)
+
+
+    def to_dict(self):
+        """Convert to a dict that can be encoded as JSON
+        (using aagen.aajson.MapEncoder for the geometry)"""
+        result = self.changes()
+        result.update({'step': self.step, 'connection': self.connection_id,
+                       'reset': self.reset, 'rolls': self.rolls})
+        return result
+
+
+    @classmethod
+    def from_dict(cls, obj):
+        """Reconstruct a StepDelta from the output of to_dict(),
+        as decoded from JSON"""
+        geometry = aagen.geometry.from_string
+        changes = {
+            'regions': [(element_id, kind, geometry(polygon), conn_ids)
+                        for (element_id, kind, polygon, conn_ids)
+                        in obj['regions']],
+            'connections': [(element_id, kind, geometry(line), direction,
+                             geometry(polygon), region_ids)
+                            for (element_id, kind, line, direction, polygon,
+                                 region_ids) in obj['connections']],
+            'decorations': [(element_id, kind, geometry(polygon),
+                             orientation, region_id)
+                            for (element_id, kind, polygon, orientation,
+                                 region_id) in obj['decorations']],
+            'kinds': [tuple(entry) for entry in obj['kinds']],
+            'polygons': [(element_id, geometry(polygon))
+                         for (element_id, polygon) in obj['polygons']],
+            'bounds': (tuple(obj['bounds']) if obj['bounds'] is not None
+                       else None),
+        }
+        return cls(obj['step'], obj['connection'], changes,
+                   [tuple(roll) for roll in obj['rolls']], obj['reset'])
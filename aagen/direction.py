@@ -22,13 +22,21 @@ class Direction:
     ALL = []
     CARDINAL = []
 
+    # Lookup tables, populated once all instances have been created:
+    # name --> Direction
+    BY_NAME = {}
+    # degrees --> Direction (exact angles only)
+    BY_DEGREES = {}
+    # (sign(x), sign(y)) of a grid-aligned baseline --> normal Direction
+    BY_NORMAL = {}
+
 
     @classmethod
     def named(cls, name):
-        for d in cls.ALL:
-            if d.name == name:
-                return d
-        raise LookupError("No Direction named '{0}'".format(name))
+        try:
+            return cls.BY_NAME[name]
+        except KeyError:
+            raise LookupError("No Direction named '{0}'".format(name))
 
 
     @classmethod
@@ -37,12 +45,22 @@ class Direction:
             baseline = baseline.coords
         (x0, y0) = baseline[0]
         (x1, y1) = baseline[-1]
-        degrees = round(math.degrees(math.atan2((x0 - x1), (y1 - y0))))
+        (dx, dy) = (x0 - x1, y1 - y0)
+        if dx == 0 or dy == 0 or dx == dy or dx == -dy:
+            # Baseline is along one of the eight grid directions
+            signs = ((dx > 0) - (dx < 0), (dy > 0) - (dy < 0))
+            if signs in cls.BY_NORMAL:
+                return cls.BY_NORMAL[signs]
+        degrees = round(math.degrees(math.atan2(dx, dy)))
         return cls.angle(degrees)
 
 
     @classmethod
     def angle(cls, degrees):
+        try:
+            return cls.BY_DEGREES[degrees]
+        except KeyError:
+            pass
         while degrees < (-180 + 22.5):
             degrees = degrees + 360
         while degrees > (180 + 22.5):
@@ -79,6 +97,13 @@ class Direction:
         self.vector = self.name_to_vector[name]
         self.degrees = math.degrees(math.atan2(self.vector[1],
                                                self.vector[0]))
+        radians = math.radians(self.degrees)
+        # (cos, sin) for rotating by this Direction's angle
+        self.rotation = (math.cos(radians), math.sin(radians))
+        # Position in Direction.ALL, and Directions rotated from this one
+        # by successive multiples of 45 degrees
+        self.index = None
+        self.rotations = []
         log.debug("Constructed {0}".format(self))
 
 
@@ -100,6 +125,8 @@ class Direction:
 
     def rotate(self, degrees):
         """Construct a new Direction relative to this one"""
+        if degrees % 45 == 0:
+            return self.rotations[int(degrees // 45) % 8]
         return Direction.angle(self.degrees + degrees)
 
 
@@ -129,3 +156,14 @@ Direction.NE = Direction("northeast")
 Direction.ALL = [Direction.N, Direction.NW, Direction.W, Direction.SW,
                  Direction.S, Direction.SE, Direction.E, Direction.NE]
 Direction.CARDINAL = [Direction.N, Direction.W, Direction.S, Direction.E]
+
+for (i, d) in enumerate(Direction.ALL):
+    d.index = i
+    Direction.BY_NAME[d.name] = d
+    Direction.BY_DEGREES[d.degrees] = d
+for d in Direction.ALL:
+    d.rotations = [Direction.angle(d.degrees + 45 * i) for i in range(8)]
+for (x, y) in [(1, 0), (1, 1), (0, 1), (-1, 1),
+               (-1, 0), (-1, -1), (0, -1), (1, -1)]:
+    Direction.BY_NORMAL[(x, y)] = Direction.angle(
+        round(math.degrees(math.atan2(x, y))))
@@ -0,0 +1,273 @@
+# aagen.frontier - expanding several parts of the dungeon at once.
+#
+# DungeonGenerator.step() expands a single incomplete connection at a time.
+# A FrontierExpander instead picks several incomplete connections whose
+# neighborhoods (everything within NEIGHBORHOOD feet of the connection) don't
+# overlap, and expands each of them against a snapshot of just that part of
+# the map - optionally in parallel worker processes. The resulting changes are
+# then committed to the real map one at a time, in the order the connections
+# were picked. Any expansion that strayed outside its own neighborhood, or that
+# comes too close to something committed earlier in the same round, is thrown
+# away and expanded again against the up-to-date map instead.
+#
+# For the outcome of each expansion to not depend on when or in which process
+# it was computed, every expansion must roll from its own random stream, so
+# this requires the generator's "counter" randomness mode.
+
+import itertools
+import logging
+import multiprocessing
+import traceback
+
+from .map import DungeonMap, Region, Connection
+from .generator import DungeonGenerator, Silenced, RANDOMNESS_COUNTER
+from .delta import combined_bounds, changes_since, apply_changes
+from aagen.direction import Direction
+import aagen.geometry
+
+log = logging.getLogger(__name__)
+
+NEIGHBORHOOD = 120
+"""Distance (in feet) from a connection within which we expect its expansion
+to stay, and within which other connections won't be expanded alongside it"""
+
+CONFLICT_MARGIN = 10
+"""Expansions whose changes come within this distance of changes committed
+earlier in the same round are considered to collide with them"""
+
+
+def neighborhood(connection, distance=NEIGHBORHOOD):
+    """Get the (xmin, ymin, xmax, ymax) bounds around the given connection
+    within which its expansion is expected to stay"""
+    (xmin, ymin, xmax, ymax) = connection.line.bounds
+    return (xmin - distance, ymin - distance, xmax + distance, ymax + distance)
+
+
+def overlaps(bounds1, bounds2, margin=0):
+    """Check whether the two given bounds come within margin of each other"""
+    return not (bounds1[0] > bounds2[2] + margin or
+                bounds1[2] < bounds2[0] - margin or
+                bounds1[1] > bounds2[3] + margin or
+                bounds1[3] < bounds2[1] - margin)
+
+
+def within(inner, outer):
+    """Check whether the inner bounds lie entirely within the outer bounds"""
+    return (inner[0] >= outer[0] and inner[1] >= outer[1] and
+            inner[2] <= outer[2] and inner[3] <= outer[3])
+
+
+def snapshot(dungeon_map, bounds):
+    """Capture the Regions and Connections of the given map that lie within
+    the given bounds, as plain data that can be sent to another process.
+    """
+    regions = [(region.id, region.kind, region.polygon)
+               for region in dungeon_map.regions
+               if overlaps(region.bounds, bounds)]
+    region_ids = set(region[0] for region in regions)
+    connections = [(conn.id, conn.kind, conn.line, conn.direction.name,
+                    conn.polygon,
+                    [region.id for region in conn.regions
+                     if region.id in region_ids])
+                   for conn in dungeon_map.connections
+                   if overlaps(conn.bounds, bounds)]
+    return {'regions': regions, 'connections': connections,
+            'next_id': dungeon_map.next_element_id,
+            'footprint': dungeon_map.footprint}
+
+
+def restore(snapshot):
+    """Construct a new DungeonMap from the given snapshot. Each element keeps
+    the same ID that it has in the original map.
+    """
+    dungeon_map = DungeonMap(footprint=snapshot['footprint'])
+    regions = {}
+    for (element_id, kind, polygon) in snapshot['regions']:
+        region = Region(kind, polygon)
+        region.id = element_id
+        regions[element_id] = region
+    # Add all of the regions before linking any connections to them, as
+    # add_region() would otherwise refresh the map for each linked region
+    for element_id in sorted(regions):
+        dungeon_map.add_region(regions[element_id], refresh=False)
+    dungeon_map.refresh_conglomerate()
+    for (element_id, kind, line, direction, polygon, region_ids) in \
+            snapshot['connections']:
+        conn = Connection(kind, line, dir=Direction.named(direction),
+                          polygon=polygon)
+        conn.id = element_id
+        conn.direction = Direction.named(direction)
+        for region_id in region_ids:
+            conn.add_region(regions[region_id])
+        dungeon_map.add_connection(conn)
+    dungeon_map.next_element_id = snapshot['next_id']
+    return dungeon_map
+
+
+def expand_snapshot(task):
+    """Expand one connection in a snapshot of the map (see snapshot()).
+    Returns the resulting changes (see changes_since()), or None if the
+    expansion failed.
+    """
+    (snap, connection_id, attempt, seed, placement, budget) = task
+    try:
+        dungeon_map = restore(snap)
+        connection = [conn for conn in dungeon_map.connections
+                      if conn.id == connection_id][0]
+        kinds = dict((conn.id, conn.kind) for conn in dungeon_map.connections)
+        polygons = dict((region.id, region.polygon)
+                        for region in dungeon_map.regions)
+        with Silenced():
+            generator = DungeonGenerator(dungeon_map, seed,
+                                         placement=placement,
+                                         randomness=RANDOMNESS_COUNTER,
+                                         step_seconds=budget[0],
+                                         step_work=budget[1])
+            generator.expansions[connection_id] = attempt
+            generator.expand(connection)
+        changes = changes_since(dungeon_map, snap['next_id'], kinds, polygons)
+        # Any fallbacks taken for running out of budget
+        changes['degraded'] = [fallback for (_, _, fallback)
+                               in generator.degradations]
+        return changes
+    except Exception:
+        log.warning("Expansion of connection {0} failed:\n{1}"
+                    .format(connection_id, traceback.format_exc()))
+        return None
+
+
+class FrontierExpander:
+    """Drives a DungeonGenerator, expanding up to the given number of
+    connections of its map in each step, using the given number of worker
+    processes. The generated dungeon depends only on the generator's seed and
+    the number of connections per step, not on the number of processes.
+    """
+
+    def __init__(self, generator, width, jobs=1):
+        if generator.randomness != RANDOMNESS_COUNTER:
+            raise ValueError("Expanding several connections at once requires "
+                             "the '{0}' randomness mode"
+                             .format(RANDOMNESS_COUNTER))
+        if width < 1:
+            raise ValueError("Must expand at least one connection per step")
+        if jobs < 1:
+            raise ValueError("Must use at least one job")
+        self.generator = generator
+        self.width = width
+        self.round_number = 0
+        # How many expansions were committed as computed, or had to be re-run
+        self.commits = 0
+        self.reruns = 0
+        self.pool = None
+        if jobs > 1:
+            self.pool = multiprocessing.Pool(
+                jobs, aagen.geometry.init_worker,
+                aagen.geometry.worker_settings())
+
+
+    def __str__(self):
+        return ("<FrontierExpander: {0} connections per step, "
+                "{1} committed, {2} re-run>"
+                .format(self.width, self.commits, self.reruns))
+
+
+    def close(self):
+        """Shut down any worker processes"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def choose_connections(self, limit):
+        """Choose up to the given number of incomplete connections, in order
+        according to the generator's schedule, no two of which have
+        overlapping neighborhoods."""
+        generator = self.generator
+        options = generator.dungeon_map.get_incomplete_connections()
+        generator.random = generator.stream("round", self.round_number)
+        chosen = []
+        for connection in generator.scheduler.ranked(generator, options):
+            area = neighborhood(connection)
+            if any(overlaps(area, other) for (_, other) in chosen):
+                continue
+            chosen.append((connection, area))
+            if len(chosen) >= limit:
+                break
+        return chosen
+
+
+    def step(self, limit=None):
+        """Expand up to self.width (and at most limit) connections at once.
+        Returns the number of connections expanded, each of which counts as
+        one step of the generator.
+        """
+        generator = self.generator
+        dungeon_map = generator.dungeon_map
+        self.round_number += 1
+        dungeon_map.flush()
+        limit = self.width if limit is None else min(limit, self.width)
+        chosen = self.choose_connections(limit)
+        if not chosen:
+            # Let the generator start over, just as it normally would
+            generator.step()
+            return 1
+
+        tasks = [(snapshot(dungeon_map, area), connection.id,
+                  generator.expansions.get(connection.id, 0),
+                  generator.seed, generator.placement,
+                  (generator.step_seconds, generator.step_work))
+                 for (connection, area) in chosen]
+        if self.pool is not None:
+            results = self.pool.imap(expand_snapshot, tasks, chunksize=1)
+        else:
+            results = (expand_snapshot(task) for task in tasks)
+
+        committed = []
+        expanded = 0
+        for ((connection, area), changes) in zip(chosen, results):
+            if not connection.is_incomplete():
+                log.info("{0} was completed by an earlier expansion"
+                         .format(connection))
+                continue
+            expanded += 1
+            generator.step_number += 1
+            print("\n\n\n----------Step {0}----------"
+                  .format(generator.step_number))
+            if (changes is not None and changes['bounds'] is not None and
+                (not within(changes['bounds'], area) or
+                 any(overlaps(changes['bounds'], other, CONFLICT_MARGIN)
+                     for other in committed))):
+                changes = None
+            if changes is not None:
+                print("Expanded {0}".format(connection))
+                generator.expansions[connection.id] = (
+                    generator.expansions.get(connection.id, 0) + 1)
+                apply_changes(dungeon_map, changes)
+                generator.degradations += [
+                    (generator.step_number, connection.id, fallback)
+                    for fallback in changes['degraded']]
+                self.commits += 1
+            else:
+                print("Expanding {0} again against the updated map"
+                      .format(connection))
+                first_id = dungeon_map.next_element_id
+                generator.expand(connection)
+                self.reruns += 1
+                changes = {'bounds': combined_bounds(
+                    [element.bounds for element in
+                     itertools.chain(dungeon_map.regions,
+                                     dungeon_map.connections)
+                     if element.id >= first_id])}
+            if changes['bounds'] is not None:
+                committed.append(changes['bounds'])
+        log.info("Finished round {0}: {1}".format(self.round_number, self))
+        return expanded
@@ -5,36 +5,92 @@
 # logic and instructs the DungeonMap as to what new Regions and
 # Connections to add.
 
-import pygame
 import logging
+import os
 import random
 import math
+import sys
+import time
+import traceback
 from .map import DungeonMap, Region, Connection, Decoration
-from .display import DungeonDisplay
 from .geometry import to_string
+from .delta import StepDelta, changes_since
+import aagen.cave
 import aagen.geometry
+import aagen.rng
+from aagen.scheduler import make_scheduler, SCHEDULE_RANDOM
 from aagen.direction import Direction
 
 log = logging.getLogger(__name__)
 
-def d4():
-    roll = random.randint(1, 4)
+# Candidate regions truncated by more than this amount (in square feet)
+# compared to the least-truncated candidate are never selected.
+TRUNCATION_EPSILON = 50
+
+# How to find placements for new rooms and chambers:
+# "edges" tries aligning each suitable edge of each shape with the connection;
+# "raster" searches all grid-aligned positions at once on the occupancy grid,
+# then evaluates only the PLACEMENT_TOP_K most promising ones exactly.
+PLACEMENT_EDGES = "edges"
+PLACEMENT_RASTER = "raster"
+PLACEMENT_MODES = [PLACEMENT_EDGES, PLACEMENT_RASTER]
+PLACEMENT_TOP_K = 12
+
+# Where the random rolls for each step come from:
+# "sequential" draws every roll in turn from a single stream for the whole
+# dungeon, so each roll depends on everything rolled before it;
+# "counter" gives the expansion of each connection its own independent stream,
+# keyed by (seed, connection id, attempt), so that the outcome of expanding a
+# connection doesn't depend on the order in which connections are expanded.
+RANDOMNESS_SEQUENTIAL = "sequential"
+RANDOMNESS_COUNTER = "counter"
+RANDOMNESS_MODES = [RANDOMNESS_SEQUENTIAL, RANDOMNESS_COUNTER]
+
+# Reasons why a run of the generator stopped (see DungeonGenerator.run())
+STOP_STEPS = "steps"
+STOP_REGIONS = "regions"
+STOP_ROOMS = "rooms"
+STOP_AREA = "area"
+STOP_TIME = "time"
+STOP_EXHAUSTED = "exhausted"
+STOP_ERROR = "error"
+
+def d4(rng=random):
+    roll = rng.randint(1, 4)
     log.info("d4 roll: {0}".format(roll))
     return roll
 
 
-def d12():
-    roll = random.randint(1, 12)
+def d12(rng=random):
+    roll = rng.randint(1, 12)
     log.info("d12 roll: {0}".format(roll))
     return roll
 
 
-def d20():
-    roll = random.randint(1, 20)
+def d20(rng=random):
+    roll = rng.randint(1, 20)
     log.info("d20 roll: {0}".format(roll))
     return roll
 
 
+class Silenced:
+    """Context manager to (if enabled) discard the generator's running
+    commentary, which it prints to standard output."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def __enter__(self):
+        if self.enabled:
+            self.stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        if self.enabled:
+            sys.stdout.close()
+            sys.stdout = self.stdout
+
+
 def filtered(l, key, epsilon=0):
     """Combination of sorted() and filter().
     Sorts based on the given criterion, then discards any list elements whose
@@ -58,14 +114,64 @@ def filtered(l, key, epsilon=0):
 class DungeonGenerator:
     """Controller class to generate the dungeon map"""
 
-    def __init__(self, dungeon_map, seed=None):
+    def __init__(self, dungeon_map, seed=None, placement=PLACEMENT_EDGES,
+                 randomness=RANDOMNESS_SEQUENTIAL, schedule=SCHEDULE_RANDOM,
+                 footprint=None, reset=True, step_seconds=None,
+                 step_work=None):
         self.dungeon_map = dungeon_map
+        # Whether to start over with a new map when this one has nothing
+        # left to expand, rather than leaving it as it is
+        self.reset = reset
+        # How much time and work (in candidate shapes evaluated) each
+        # expansion of a connection may take before settling for the
+        # cheapest acceptable outcome - see over_budget()
+        self.step_seconds = step_seconds
+        self.step_work = step_work
+        self.step_start = time.time()
+        self.work_done = 0
+        # (step number, connection ID, fallback) for each expansion that ran
+        # out of budget
+        self.degradations = []
+
+        if footprint is not None:
+            # The entrance stairs may lead in any direction from the origin
+            if not footprint.contains(aagen.geometry.box(-20, -20, 20, 20)):
+                raise ValueError("Footprint {0} does not contain the entrance"
+                                 .format(to_string(footprint)))
+            dungeon_map.set_footprint(footprint)
+
+        if not placement in PLACEMENT_MODES:
+            raise ValueError("Unknown placement mode '{0}'".format(placement))
+        self.placement = placement
+        if not randomness in RANDOMNESS_MODES:
+            raise ValueError("Unknown randomness mode '{0}'"
+                             .format(randomness))
+        self.randomness = randomness
+        # Policy for choosing which incomplete connection to expand next
+        self.schedule = schedule
+        self.scheduler = make_scheduler(schedule)
+
+        # Searches that have failed, mapping each search's parameters to the
+        # version of the local map geometry at the time it failed
+        self.failed_searches = {}
+        self.search_cache_hits = 0
+        self.search_cache_misses = 0
 
         if seed is None:
             seed = random.randint(0, 2 ** 31)
         self.seed = seed
         self.print_seed()
-        random.seed(self.seed)
+        # Our own source of randomness, so that other generators (or anything
+        # else using the random module) can't affect the dungeon we generate.
+        # self.random is whichever stream the current step should roll from.
+        self.sequence = random.Random(self.seed)
+        self.random = self.stream("entrance")
+        # Number of times each connection (by ID) has been expanded
+        self.expansions = {}
+        # (roll, description) for each roll made in the current expansion,
+        # and the connection being expanded
+        self.rolls = []
+        self.connection = None
 
         log.info("Initialized {0}".format(self))
 
@@ -75,9 +181,16 @@ class DungeonGenerator:
             print("Using existing map.")
             return
 
+        with dungeon_map.activate():
+            self.generate_entrance()
+
+
+    def generate_entrance(self):
+        """Construct the entrance stairs and the first room of a new dungeon"""
+        dungeon_map = self.dungeon_map
         print("Generating new dungeon!")
         print("Adding initial entrance stairs (d4)")
-        roll = d4()
+        roll = d4(self.random)
         if roll == 1:
             stairs_dir = Direction.N
             stairs_coords = [(10, 0), (0, 0), (0, -20), (10, -20)]
@@ -108,16 +221,226 @@ class DungeonGenerator:
         self.generate_room(Region.ROOM, stairs_to_room)
 
 
+    def stream(self, *key):
+        """Get the source of randomness for the decisions identified by the
+        given key. In sequential mode this is always the same single stream.
+        """
+        if self.randomness == RANDOMNESS_COUNTER:
+            return aagen.rng.CounterRandom(self.seed, *key)
+        return self.sequence
+
+
     def __str__(self):
         return ("<DungeonGenerator: with map {0}>"
                 .format(self.dungeon_map))
 
 
+    def summary(self):
+        """Describe the current state of the map, as a dict of the number of
+        'regions', 'rooms' (including chambers) and square feet of 'area',
+        and how many steps (counting the entrance as step 0) were 'degraded'
+        by running out of budget"""
+        regions = self.dungeon_map.regions
+        return {
+            'regions': len(regions),
+            'rooms': len([r for r in regions if r.kind != Region.PASSAGE]),
+            'area': self.dungeon_map.conglomerate_polygon.area,
+            'degraded': len(set(step for (step, _, _)
+                                in self.degradations)),
+        }
+
+
+    def stop_reason(self, regions=None, rooms=None, area=None):
+        """Check whether the map satisfies any of the given stop conditions
+        (or, if not resetting, can't grow any further).
+        Returns the reason to stop, or None.
+        """
+        summary = self.summary()
+        if regions is not None and summary['regions'] >= regions:
+            return STOP_REGIONS
+        if rooms is not None and summary['rooms'] >= rooms:
+            return STOP_ROOMS
+        if area is not None and summary['area'] >= area:
+            return STOP_AREA
+        if (not self.reset and
+            not self.dungeon_map.get_incomplete_connections()):
+            return STOP_EXHAUSTED
+        return None
+
+
+    def run(self, steps=None, regions=None, rooms=None, area=None,
+            seconds=None, expander=None, after_step=None):
+        """Run steps of the generator until any of the given stop conditions
+        is met: the given number of steps have been run, the map has at least
+        the given number of regions, rooms or square feet of area, the given
+        number of seconds have passed (checked between steps), or (if not
+        resetting) the map has no incomplete connections left to expand.
+
+        If an expander (such as an aagen.frontier.FrontierExpander) is given,
+        each of its steps expands several connections at once.
+        If given, after_step() is called after each successful step.
+
+        Returns a dict summarizing the run: the 'reason' it stopped, the
+        number of 'steps' run, the 'time' taken in seconds, the final
+        counts (see summary()), and the 'error' (the formatted traceback if
+        a step raised an exception, otherwise None). A step that fails is
+        rolled back, leaving the map as it was after the last successful
+        step.
+        """
+        if (steps is None and regions is None and rooms is None and
+            area is None and seconds is None and self.reset):
+            raise ValueError("No stop condition given - this would never end")
+
+        start = time.time()
+        steps_run = 0
+        error = None
+        while True:
+            if steps is not None and steps_run >= steps:
+                reason = STOP_STEPS
+                break
+            reason = self.stop_reason(regions, rooms, area)
+            if reason is not None:
+                break
+            if seconds is not None and time.time() - start >= seconds:
+                reason = STOP_TIME
+                break
+            saved = self.save_map()
+            try:
+                if expander is not None:
+                    steps_run += expander.step(
+                        None if steps is None else steps - steps_run)
+                else:
+                    self.step()
+                    steps_run += 1
+            except Exception:
+                error = traceback.format_exc()
+                reason = STOP_ERROR
+                self.restore_map(saved)
+                break
+            if after_step is not None:
+                after_step()
+
+        result = self.summary()
+        result.update({'reason': reason, 'steps': steps_run,
+                       'time': time.time() - start, 'error': error})
+        log.info("Run stopped ({reason}) after {steps} steps"
+                 .format(**result))
+        return result
+
+
+    def save_map(self):
+        """Capture the map, and the step counters and records that go with
+        it, as they are now, so that restore_map() can put them back this
+        way if a step fails partway through"""
+        dungeon_map = self.dungeon_map
+        return (StepDelta.of_map(dungeon_map), dungeon_map.id,
+                dungeon_map.next_element_id, self.step_number,
+                dict(self.expansions), list(self.degradations),
+                dict(self.failed_searches))
+
+
+    def restore_map(self, saved):
+        """Put the map back the way it was when save_map() was called"""
+        (delta, map_id, next_element_id, step_number, expansions,
+         degradations, failed_searches) = saved
+        dungeon_map = self.dungeon_map
+        log.info("Rolling back {0}".format(dungeon_map))
+        delta.apply(dungeon_map)
+        dungeon_map.id = map_id
+        dungeon_map.next_element_id = next_element_id
+        dungeon_map.flush()
+        self.step_number = step_number
+        self.expansions = expansions
+        self.degradations = degradations
+        # The map's local versions start over, so searches that failed in
+        # the rolled-back step could otherwise match later map geometry
+        self.failed_searches = failed_searches
+
+
+    def charge(self, work=1):
+        """Count the given amount of work against the current step's budget"""
+        self.work_done += work
+
+
+    def over_budget(self):
+        """Check whether the current expansion has used up its time or work
+        budget, in which case it should settle for the cheapest acceptable
+        outcome rather than searching any further."""
+        if self.step_work is not None and self.work_done >= self.step_work:
+            return True
+        if (self.step_seconds is not None and
+            time.time() - self.step_start >= self.step_seconds):
+            return True
+        return False
+
+
+    def degrade(self, connection, fallback):
+        """Record that the current expansion ran out of budget and settled
+        for the given fallback"""
+        print("Out of budget for this step - settling for {0}"
+              .format(fallback))
+        log.info("Expansion of {0} in step {1} degraded to {2}"
+                 .format(connection, self.step_number, fallback))
+        self.degradations.append((self.step_number, connection.id, fallback))
+
+
     def print_seed(self):
         print("Random seed: {0}".format(self.seed))
 
 
+    def print_search_cache_stats(self):
+        lookups = self.search_cache_hits + self.search_cache_misses
+        print("Failed-search cache: {0} hits out of {1} lookups ({2:.0%})"
+              .format(self.search_cache_hits, lookups,
+                      (float(self.search_cache_hits) / lookups
+                       if lookups else 0)))
+
+
+    def check_failed_search(self, key, bounds):
+        """Check whether an identical search, in the given bounds of the map,
+        has already failed with the map geometry in these bounds as it is now.
+        Returns the tuple (failed, version), where version is the current local
+        map version to pass to record_failed_search() if the search fails.
+        """
+        version = self.dungeon_map.version_near(bounds)
+        if self.failed_searches.get(key) == version:
+            self.search_cache_hits += 1
+            log.info("Search {0} already failed and nothing nearby has "
+                     "changed since".format(key))
+            return (True, version)
+        self.search_cache_misses += 1
+        return (False, version)
+
+
+    def record_failed_search(self, key, version):
+        self.failed_searches[key] = version
+
+
+    def construct_intersection(self, connection, base_dir, exit_dir_list,
+                               exit_width, exit_helper=None):
+        """Wrapper for DungeonMap.construct_intersection() that skips
+        repeating an attempt that has already failed.
+        Returns (region, [new_conn1, new_conn2, ...]) or (None, [])
+        """
+        search_key = (connection.id, "intersection", connection.kind,
+                      connection.line.bounds, base_dir.name,
+                      tuple(d.name for d in exit_dir_list), exit_width)
+        reach = 2 * (exit_width + connection.size())
+        (xmin, ymin, xmax, ymax) = connection.line.bounds
+        (failed, version) = self.check_failed_search(
+            search_key,
+            (xmin - reach, ymin - reach, xmax + reach, ymax + reach))
+        if failed:
+            return (None, [])
+        (region, conns) = self.dungeon_map.construct_intersection(
+            connection, base_dir, exit_dir_list, exit_width, exit_helper)
+        if region is None:
+            self.record_failed_search(search_key, version)
+        return (region, conns)
+
+
     def print_roll(self, roll, string):
+        self.rolls.append((roll, string))
         print("{roll}\t{string}".format(roll=roll, string=string))
 
 
@@ -125,9 +448,15 @@ class DungeonGenerator:
         """Continue a passage from the given Connection.
         """
 
+        if self.over_budget():
+            # Don't keep rerolling
+            self.degrade(connection, "a dead end")
+            self.construct_dead_end(connection)
+            return
+
         print("Rolling for passage continuation from {0}".format(connection))
 
-        roll = d20()
+        roll = d20(self.random)
 
         if roll <= 2:
             self.print_roll(roll, "Passage continues straight for 60 feet")
@@ -172,11 +501,13 @@ class DungeonGenerator:
             self.print_roll(roll, "A monster is here - roll again for passage "
                             "continuation")
             # TODO monster
+            self.charge()
             self.continue_passage(connection)
             return
 
         # TODO
         log.info("Rerolling")
+        self.charge()
         self.continue_passage(connection)
 
     def construct_dead_end(self, connection):
@@ -190,7 +521,7 @@ class DungeonGenerator:
         exit_dirs = [base_dir, base_dir.rotate(90), base_dir.rotate(-90)]
 
         def exit_helper(direction, exit_line, region):
-            roll = d20()
+            roll = d20(self.random)
             if roll <= 5:
                 self.print_roll(roll, "A secret door to the {0}"
                                 .format(direction))
@@ -202,8 +533,9 @@ class DungeonGenerator:
                                 .format(direction))
                 return None
 
-        (region, conns) = self.dungeon_map.construct_intersection(
+        (region, conns) = self.construct_intersection(
             connection, base_dir, exit_dirs, 10, exit_helper)
+        return region
 
 
     def generate_door_in_passage(self, connection):
@@ -218,7 +550,7 @@ class DungeonGenerator:
 
         # We can generate anywhere from 1 to 3 doors (left / right / ahead).
         while True:
-            roll = d20()
+            roll = d20(self.random)
             if roll <= 6:
                 self.print_roll(roll, "Door to the left")
                 exit_dirs.add(base_dir.rotate(90))
@@ -232,7 +564,7 @@ class DungeonGenerator:
                 break
 
             # Should we generate more doors?
-            roll = d20()
+            roll = d20(self.random)
             if (3 <= roll and roll <= 5):
                 self.print_roll(roll, "Roll again")
             else:
@@ -240,6 +572,8 @@ class DungeonGenerator:
                 break
 
         def exit_helper(exit_dir, exit_line, region):
+            if self.dungeon_map.leaves_footprint(exit_line):
+                return None
             # Would the exit enter mapped space?
             boundary = self.dungeon_map.conglomerate_polygon.boundary
             # If an "ahead" door is not generated, passage continues
@@ -262,7 +596,7 @@ class DungeonGenerator:
                     return Connection(Connection.DOOR, exit_line, region,
                                       exit_dir)
 
-        (region, conns) = self.dungeon_map.construct_intersection(
+        (region, conns) = self.construct_intersection(
             connection, base_dir, exit_dirs, 10, exit_helper)
 
         # If an "ahead" door is not generated, passage continues
@@ -277,7 +611,7 @@ class DungeonGenerator:
         """
         print("The door ({0}) opens...".format(connection))
 
-        roll = d20()
+        roll = d20(self.random)
 
         if roll <= 4:
             self.print_roll(roll, "The door opens into a parallel passage "
@@ -317,7 +651,7 @@ class DungeonGenerator:
         print("A side passage branches off...")
         base_dir = connection.direction
 
-        roll = d20()
+        roll = d20(self.random)
 
         if roll <= 2:
             self.print_roll(roll, "It branches to the left")
@@ -356,7 +690,7 @@ class DungeonGenerator:
             dirs = [base_dir, base_dir.rotate(-90), base_dir.rotate(90)]
         else:
             self.print_roll(roll, "An X-junction")
-            roll = d20()
+            roll = d20(self.random)
             if roll <= 10:
                 self.print_roll(roll, "X-junction to the left")
                 dirs = [base_dir, base_dir.rotate(45), base_dir.rotate(-135)]
@@ -367,7 +701,7 @@ class DungeonGenerator:
         # TODO - roll and track width separately for cardinal/diagonal exits
         new_width = self.roll_passage_width()
 
-        (region, conns) = self.dungeon_map.construct_intersection(
+        (region, conns) = self.construct_intersection(
             connection, base_dir, dirs, new_width)
         return conns
 
@@ -382,7 +716,7 @@ class DungeonGenerator:
         new_dirs = [base_dir.rotate(90), base_dir.rotate(-90)]
         new_width = self.roll_passage_width(new_dirs[0].is_cardinal())
 
-        (region, conns) = self.dungeon_map.construct_intersection(
+        (region, conns) = self.construct_intersection(
             connection, base_dir, new_dirs, new_width)
         return conns
 
@@ -390,7 +724,7 @@ class DungeonGenerator:
     def roll_passage_width(self, cardinal=True):
         print("Checking passage width...")
 
-        roll = d20()
+        roll = d20(self.random)
 
         if roll <= 12:
             self.print_roll(roll, "10 feet wide")
@@ -425,7 +759,7 @@ class DungeonGenerator:
         """
         print("Generating a turn in the passage...")
 
-        roll = d20()
+        roll = d20(self.random)
 
         base_dir = connection.direction
 
@@ -470,7 +804,7 @@ class DungeonGenerator:
 
         log.info("Passage turns from {0} to {1} and becomes {2} wide"
                  .format(base_dir, new_dir, width))
-        (region, conns) = self.dungeon_map.construct_intersection(
+        (region, conns) = self.construct_intersection(
             connection, base_dir, [new_dir], width)
 
         if region:
@@ -494,9 +828,25 @@ class DungeonGenerator:
             polygons = self.roll_room_shape_and_size(kind)
             log.info("Set contains {0} different shapes"
                      .format(len(polygons)))
-
-            candidate_regions = self.dungeon_map.find_options_for_region(
-                polygons, connection)
+            self.charge(len(polygons))
+            degraded = self.over_budget()
+            if degraded:
+                self.degrade(connection, "the smallest {0}".format(kind))
+                polygons = self.roll_smallest_room(kind, connection.size())
+
+            candidate_regions = None
+            if self.placement == PLACEMENT_RASTER:
+                candidate_regions = (
+                    self.dungeon_map.find_placements_for_region(
+                        polygons, connection, PLACEMENT_TOP_K))
+            if not candidate_regions:
+                candidate_regions = self.dungeon_map.find_options_for_region(
+                    polygons, connection, TRUNCATION_EPSILON)
+            if degraded and not candidate_regions:
+                print("No space for even the smallest {0} - "
+                      "it dead-ends instead".format(kind))
+                self.construct_dead_end(connection)
+                return
             selected_region = self.select_best_candidate(candidate_regions)
             if selected_region.amount_truncated > 0:
                 print("Room is truncated a bit... oh well")
@@ -518,6 +868,10 @@ class DungeonGenerator:
             exit_base_dir = connection.direction
             # TODO use actual adjacency direction?
             for i in range(0, num_exits):
+                if i > 0 and self.over_budget():
+                    self.degrade(connection, "{0} of {1} exits"
+                                 .format(i, num_exits))
+                    break
                 print("Generating exit #{0}".format(i+1))
                 self.generate_room_exit(new_region, exit_kind, exit_base_dir)
         else:
@@ -526,7 +880,7 @@ class DungeonGenerator:
                 candidates = self.dungeon_map.find_options_for_connection(
                     10, new_region, direction)
                 for candidate in candidates:
-                    roll = d12()
+                    roll = d12(self.random)
                     if roll == 1:
                         self.print_roll(roll, "Secret door here!")
                         conn = Connection(Connection.SECRET, candidate.line,
@@ -552,7 +906,7 @@ class DungeonGenerator:
                                          lambda r: round(r.polygon.area))
 
         # Randomly choose amongst the rest
-        return random.choice(candidate_connections)
+        return self.random.choice(candidate_connections)
 
 
     def select_best_candidate(self, candidate_regions):
@@ -626,11 +980,11 @@ class DungeonGenerator:
         # Least truncation - discard all those that don't make the cut!
         candidate_regions = filtered(candidate_regions,
                                      key=lambda r: round(r.amount_truncated),
-                                     epsilon=50)
+                                     epsilon=TRUNCATION_EPSILON)
         log.debug("Candidates: {0}"
                  .format("\n".join(str(r) for r in candidate_regions)))
 
-        selected_region = random.choice(candidate_regions)
+        selected_region = self.random.choice(candidate_regions)
         log.debug("Selected candidate {0}".format(selected_region))
         return selected_region
 
@@ -640,7 +994,7 @@ class DungeonGenerator:
         Returns a set of sequences of polygon coordinates"""
         print("Rolling shape and size for a {0} (d20)".format(kind))
 
-        roll = d20()
+        roll = d20(self.random)
 
         # TODO force unusual rooms:
         #return self.roll_room_unusual_shape_and_size()
@@ -670,6 +1024,13 @@ class DungeonGenerator:
         return aagen.geometry.rectangle_list(w, h)
 
 
+    def roll_smallest_room(self, kind, width):
+        """The shapes for the smallest Room or Chamber that can fit a
+        connection of the given width"""
+        (w, h) = (10, 10) if kind == Region.ROOM else (20, 20)
+        return aagen.geometry.rectangle_list(max(w, width), h)
+
+
     def roll_room_unusual_shape_and_size(self):
 
         # First we roll the area:
@@ -677,7 +1038,7 @@ class DungeonGenerator:
 
         print("Generating unusual shape (d20)...")
 
-        roll = d20()
+        roll = d20(self.random)
 
         if roll <= 5:
             self.print_roll(roll, "A circle")
@@ -692,7 +1053,8 @@ class DungeonGenerator:
             return aagen.geometry.trapezoid_list(area)
         elif roll <= 13:
             self.print_roll(roll, "Something odd...")
-            # TODO
+            # A rough, irregular chamber - a barely-smoothed cave
+            return aagen.cave.cave_list(area, smoothing=2, rng=self.random)
         elif roll <= 15:
             self.print_roll(roll, "An oval")
             return aagen.geometry.oval_list(area)
@@ -705,16 +1067,13 @@ class DungeonGenerator:
             return aagen.geometry.octagon_list(area)
         else:
             self.print_roll(roll, "A cave?")
-            # TODO
-
-        log.info("Rerolling")
-        return self.roll_room_unusual_shape_and_size()
+            return aagen.cave.cave_list(area, rng=self.random)
 
 
     def roll_room_unusual_size(self):
         print("Generating unusual room size (d20)...")
 
-        roll = d20()
+        roll = d20(self.random)
 
         if roll <= 3:
             size = 500
@@ -745,7 +1104,7 @@ class DungeonGenerator:
     def roll_room_exit_count(self, room):
         print("Generating number of exits...")
 
-        roll = d20()
+        roll = d20(self.random)
 
         exit_kind = (Connection.DOOR if room.kind == Region.ROOM
                      else Connection.ARCH)
@@ -761,7 +1120,7 @@ class DungeonGenerator:
         elif roll <= 15:
             exits = self.exits_if_area_less_than(roll, room, 1600, 0, 1)
         elif roll <= 18:
-            exits = d4()
+            exits = d4(self.random)
             self.print_roll(roll, "1-4 exits: got {0} exits".format(exits))
         else:
             exits = 1
@@ -808,6 +1167,7 @@ class DungeonGenerator:
         exit_width = width
         conn = None
         while exit_width > 0:
+            self.charge()
             candidates = self.dungeon_map.find_options_for_connection(
                 exit_width, room, exit_dir)
             log.debug(candidates)
@@ -822,7 +1182,7 @@ class DungeonGenerator:
             print("If there's no available space that doesn't already lead to "
                   "an already mapped area, it might be a secret or a one-way "
                   "door, or else we should just try a different wall...")
-            roll = d20()
+            roll = d20(self.random)
             if roll <= 5:
                 self.print_roll(roll, "There's a secret door")
                 exit_kind = Connection.SECRET
@@ -854,8 +1214,9 @@ class DungeonGenerator:
 
         # For now just pick one at random:
         candidate = self.select_best_connection(candidates)
-        room.polygon = aagen.geometry.union(room.polygon, candidate.polygon)
-        self.dungeon_map.refresh_conglomerate()
+        room.polygon = aagen.geometry.normalize(
+            aagen.geometry.union(room.polygon, candidate.polygon))
+        self.dungeon_map.refresh_conglomerate(room)
         conn = Connection(exit_kind, candidate.line, room, exit_dir)
         room.add_connection(conn)
         self.dungeon_map.add_connection(conn)
@@ -868,7 +1229,7 @@ class DungeonGenerator:
 
     def roll_room_exit_location(self, base_direction):
         print("Generating exit location...")
-        roll = d20()
+        roll = d20(self.random)
 
         if base_direction.is_cardinal():
             if roll <= 7:
@@ -915,7 +1276,7 @@ class DungeonGenerator:
 
     def roll_passage_exit_directions(self, base_direction):
         print("Generating exit direction for a passage...")
-        roll = d20()
+        roll = d20(self.random)
 
         if roll <= 16:
             self.print_roll(roll, "The passage goes straight {0}"
@@ -942,11 +1303,29 @@ class DungeonGenerator:
                        allow_truncation=True,
                        allow_shortening=True):
         """Grow a passage from the given connection.
-        Returns the resulting passage or None """
+        Returns the resulting passage or None if it can't be extended at all.
+        If the step runs out of budget partway through, the connection is
+        always completed, by a shorter passage or a dead end
+        (see settle_for_short_passage())."""
 
         if possible_directions is None:
             possible_directions = [connection.direction]
 
+        # The outcome depends only on the map geometry within reach of the
+        # connection, so don't repeat a search that has already failed
+        search_key = (connection.id, "passage", connection.kind,
+                      connection.line.bounds, distance,
+                      tuple(d.name for d in possible_directions),
+                      allow_truncation, allow_shortening)
+        reach = distance + connection.size()
+        (xmin, ymin, xmax, ymax) = connection.line.bounds
+        (failed, version) = self.check_failed_search(
+            search_key,
+            (xmin - reach, ymin - reach, xmax + reach, ymax + reach))
+        if failed:
+            log.warning("Unable to extend passage at all!")
+            return None
+
         # Order of preference:
         # 1) First possible direction, full distance, no truncation
         # 2) Second possible direction, full distance, no truncation
@@ -955,26 +1334,56 @@ class DungeonGenerator:
         # If distance reduced to 0 and still no match found:
         # Reset to maximum distance, allow truncation, repeat all of the above
 
-        (xmin, ymin, xmax, ymax) = connection.line.bounds
+        # The base line and turn geometry for each direction don't depend on
+        # the passage length, so work them out once up front, along with how
+        # far the passage could extend in each direction without truncation.
+        bases = {}
+        clearances = {}
+        for direction in possible_directions:
+            if direction != connection.direction:
+                # TODO - map.construct_intersection() instead?
+                (fixup_poly, exit_dict) = (
+                    aagen.geometry.construct_intersection(
+                        connection.line, connection.direction,
+                        [direction], connection.size()
+                    ))
+                base_line = exit_dict[direction]
+            else:
+                base_line = connection.line
+                fixup_poly = aagen.geometry.polygon()
+            bases[direction] = (base_line, fixup_poly)
+            clearances[direction] = self.dungeon_map.free_distance(
+                base_line, direction, distance, fixup_poly)
+
         for truncation in [False, True]:
             length = distance
+            if not truncation and allow_shortening:
+                # Skip straight to the longest length that might fit
+                best = max(clearances.values())
+                while (length - 10 > 0 and
+                       length > best + aagen.geometry.SNAP_TOLERANCE):
+                    length -= 10
             while length > 0:
                 for direction in possible_directions:
-                    if direction != connection.direction:
-                        # TODO - map.construct_intersection() instead?
-                        (fixup_poly, exit_dict) = (
-                            aagen.geometry.construct_intersection(
-                                connection.line, connection.direction,
-                                [direction], connection.size()
-                            ))
-                        base_line = exit_dict[direction]
-                    else:
-                        base_line = connection.line
-                        fixup_poly = aagen.geometry.polygon()
+                    if self.over_budget():
+                        return self.settle_for_short_passage(
+                            connection, possible_directions, bases)
+                    if (not truncation and length > clearances[direction] +
+                        aagen.geometry.SNAP_TOLERANCE):
+                        log.debug("Passage to the {0} would be truncated "
+                                  "beyond {1}'"
+                                  .format(direction, clearances[direction]))
+                        continue
+                    (base_line, fixup_poly) = bases[direction]
                     (polygon, endwall) = aagen.geometry.sweep(
                         base_line, direction, length,
                         connection.direction)
                     polygon = aagen.geometry.union(polygon, fixup_poly)
+                    if (not truncation and
+                        self.dungeon_map.occupancy.overlaps(polygon)):
+                        log.info("Would be truncated - not interested")
+                        continue
+                    self.charge()
                     candidate = self.dungeon_map.try_region_as_candidate(
                         polygon, connection)
                     if candidate is not None:
@@ -998,26 +1407,8 @@ class DungeonGenerator:
                     #            filtered.append(candidate)
                     #if len(filtered) > 0:
                         #selected = self.select_best_candidate(filtered)
-                        new_region = Region(Region.PASSAGE,
-                                            selected.polygon)
-                        connection.add_region(new_region)
-                        if selected.amount_truncated == 0:
-                            # add Open connection to far end of passage if
-                            # it doesn't collide with the geometry
-                            if (aagen.geometry.intersect(
-                                    endwall,
-                                    self.dungeon_map.conglomerate_polygon)
-                                .length == 0):
-                                conn2 = Connection(Connection.OPEN,
-                                                   endwall,
-                                                   new_region,
-                                                   direction)
-                            else:
-                                log.info("Not adding Open at end of passage {0}"
-                                         "because it intersects the existing "
-                                         "dungeon".format(to_string(endwall)))
-                        self.dungeon_map.add_region(new_region)
-                        return new_region
+                        return self.add_passage(connection, selected, endwall,
+                                                direction)
                     # No luck - try new direction?
                     pass
                 # No luck - try reducing length?
@@ -1033,38 +1424,151 @@ class DungeonGenerator:
 
         # No luck at all?
         log.warning("Unable to extend passage at all!")
+        self.record_failed_search(search_key, version)
         return None
 
 
+    def add_passage(self, connection, candidate, endwall, direction):
+        """Add the passage described by the given candidate region, extending
+        from the given connection, to the map. Returns the new region."""
+        new_region = Region(Region.PASSAGE, candidate.polygon)
+        connection.add_region(new_region)
+        if candidate.amount_truncated == 0:
+            # add Open connection to far end of passage if
+            # it doesn't collide with the geometry
+            if (aagen.geometry.intersect(
+                    endwall, self.dungeon_map.occupied_polygon).length == 0):
+                conn2 = Connection(Connection.OPEN, endwall, new_region,
+                                   direction)
+            else:
+                log.info("Not adding Open at end of passage {0}"
+                         "because it intersects the existing "
+                         "dungeon".format(to_string(endwall)))
+        self.dungeon_map.add_region(new_region)
+        return new_region
+
+
+    def settle_for_short_passage(self, connection, possible_directions,
+                                 bases):
+        """Once extend_passage() has run out of budget, extend the passage
+        by just 10 feet (truncated if need be), or failing that, dead-end it.
+        Returns the resulting passage or dead end"""
+        self.degrade(connection, "a short passage")
+        for direction in possible_directions:
+            (base_line, fixup_poly) = bases[direction]
+            (polygon, endwall) = aagen.geometry.sweep(
+                base_line, direction, 10, connection.direction)
+            polygon = aagen.geometry.union(polygon, fixup_poly)
+            candidate = self.dungeon_map.try_region_as_candidate(
+                polygon, connection)
+            if candidate is not None:
+                return self.add_passage(connection, candidate, endwall,
+                                        direction)
+        print("No room for even a short passage - it dead-ends instead")
+        return self.construct_dead_end(connection)
+
+
     def step(self, connection=None):
         """Run another step of the dungeon generation algorithm, either
         starting from the specified connection or a random one"""
 
-        self.step_number += 1
-
-        print("\n\n\n----------Step {0}----------".format(self.step_number))
-        self.dungeon_map.flush()
-        log.info(self.dungeon_map)
-        if connection is None:
-            # Choose a connection at random
-            options = self.dungeon_map.get_incomplete_connections()
-            if (len(options) == 0):
-                log.warning("Resetting map!")
-                self.dungeon_map.__init__()
-                self.__init__(self.dungeon_map)
-                return
-            connection = random.choice(options)
-
-        log.info("Generating next step from {0}".format(connection))
-
-        if (connection.kind == Connection.DOOR or
-            connection.kind == Connection.SECRET or
-            connection.kind == Connection.ONEWAY):
-            self.generate_space_beyond_door(connection)
-        elif (connection.kind == Connection.OPEN or
-              connection.kind == Connection.ARCH):
-            self.continue_passage(connection)
-        else:
-            raise NotImplementedError("No handling for {0} yet"
-                                      .format(connection.kind))
+        if (connection is None and not self.reset and
+            not self.dungeon_map.get_incomplete_connections()):
+            print("Nothing left to expand - the dungeon is complete.")
+            return
 
+        with self.dungeon_map.activate():
+            self.step_number += 1
+
+            print("\n\n\n----------Step {0}----------"
+                  .format(self.step_number))
+            self.dungeon_map.flush()
+            log.info(self.dungeon_map)
+            self.random = self.stream("step", self.step_number)
+            if connection is None:
+                # Choose a connection according to our schedule
+                options = self.dungeon_map.get_incomplete_connections()
+                if (len(options) == 0):
+                    log.warning("Resetting map!")
+                    self.dungeon_map.__init__(
+                        footprint=self.dungeon_map.footprint)
+                    self.__init__(self.dungeon_map,
+                                  self.random.randint(0, 2 ** 31),
+                                  placement=self.placement,
+                                  randomness=self.randomness,
+                                  schedule=self.schedule,
+                                  step_seconds=self.step_seconds,
+                                  step_work=self.step_work)
+                    return
+                connection = self.scheduler.choose(self, options)
+
+            self.expand(connection)
+
+
+    def step_delta(self, connection=None):
+        """Run another step (see step()) and return a StepDelta describing
+        how it changed the map"""
+        dungeon_map = self.dungeon_map
+        map_id = dungeon_map.id
+        first_id = dungeon_map.next_element_id
+        kinds = dict((conn.id, conn.kind) for conn in dungeon_map.connections)
+        polygons = dict((region.id, region.polygon)
+                        for region in dungeon_map.regions)
+        self.rolls = []
+        self.connection = None
+        self.step(connection)
+        if dungeon_map.id != map_id:
+            # The map was discarded and a new one generated in its place
+            return StepDelta.of_map(dungeon_map, self.step_number, self.rolls)
+        return StepDelta(self.step_number,
+                         (self.connection.id if self.connection is not None
+                          else None),
+                         changes_since(dungeon_map, first_id, kinds,
+                                       polygons),
+                         self.rolls)
+
+
+    def iter_steps(self, steps=None, initial=False):
+        """Run steps of the generator one at a time as the caller iterates,
+        yielding a StepDelta describing how each step changed the map.
+        If initial is set, first yield a delta describing the map as it
+        already is. Stops after the given number of steps or (if not
+        resetting) once the map has nothing left to expand; otherwise it
+        never stops by itself.
+        """
+        if initial:
+            yield StepDelta.of_map(self.dungeon_map, self.step_number,
+                                   self.rolls)
+        steps_run = 0
+        while steps is None or steps_run < steps:
+            if (not self.reset and
+                not self.dungeon_map.get_incomplete_connections()):
+                return
+            yield self.step_delta()
+            steps_run += 1
+
+
+    def expand(self, connection):
+        """Expand the given incomplete connection into whatever lies beyond
+        it (without counting this as a new step)."""
+        with self.dungeon_map.activate():
+            self.step_start = time.time()
+            self.work_done = 0
+            self.rolls = []
+            self.connection = connection
+            attempt = self.expansions.get(connection.id, 0)
+            self.expansions[connection.id] = attempt + 1
+            self.random = self.stream("expand", connection.id, attempt)
+
+            log.info("Generating next step from {0}".format(connection))
+
+            if (connection.kind == Connection.DOOR or
+                connection.kind == Connection.SECRET or
+                connection.kind == Connection.ONEWAY):
+                self.generate_space_beyond_door(connection)
+            elif (connection.kind == Connection.OPEN or
+                  connection.kind == Connection.ARCH):
+                self.continue_passage(connection)
+            else:
+                raise NotImplementedError("No handling for {0} yet"
+                                          .format(connection.kind))
@@ -4,6 +4,8 @@ import logging
 import math
 import re
 import ast
+from fractions import Fraction
+from itertools import count
 
 from aagen.direction import Direction
 
@@ -22,6 +24,94 @@ from shapely.validation import explain_validity
 
 log = logging.getLogger(__name__)
 
+# Geometry validation.
+# Many of the functions in this module double-check that the geometry they
+# construct is valid. These checks are invaluable during development but are
+# not free, so for batch runs they can be sampled or disabled entirely.
+
+VALIDATION_STRICT = "strict"
+VALIDATION_SAMPLED = "sampled"
+VALIDATION_OFF = "off"
+VALIDATION_MODES = [VALIDATION_STRICT, VALIDATION_SAMPLED, VALIDATION_OFF]
+
+validation_mode = VALIDATION_STRICT
+# In sampled mode, only one out of every this-many checks is performed
+validation_sample_interval = 100
+_validation_count = count(0)
+
+
+def set_validation(mode, sample_interval=None):
+    """Set the level of geometry validation to perform: "strict" (always),
+    "sampled" (once every sample_interval checks), or "off" (never).
+    """
+    global validation_mode, validation_sample_interval
+    if not mode in VALIDATION_MODES:
+        raise ValueError("Unknown validation mode '{0}'".format(mode))
+    validation_mode = mode
+    if sample_interval is not None:
+        validation_sample_interval = sample_interval
+    log.info("Geometry validation is now {0}".format(mode))
+
+
+def validating():
+    """Returns whether the caller should check the validity of its geometry"""
+    if validation_mode == VALIDATION_STRICT:
+        return True
+    elif validation_mode == VALIDATION_OFF:
+        return False
+    return next(_validation_count) % validation_sample_interval == 0
+
+
+# Curved shapes.
+# Circles and ovals can either be constructed as smooth curves (with many
+# off-grid vertices) or as grid-snapped polygons made only of orthogonal and
+# diagonal edges. The latter have far fewer vertices, which keeps every later
+# geometric operation on the map (and every wall drawn) cheaper.
+
+CURVE_SMOOTH = "smooth"
+CURVE_GRID = "grid"
+CURVE_MODES = [CURVE_SMOOTH, CURVE_GRID]
+
+curve_mode = CURVE_SMOOTH
+# In grid mode, the maximum number of vertices for any single curve
+curve_vertex_limit = 16
+# In grid mode, the range of sizes of the cut across each corner of a circle,
+# as a fraction of its width (a regular octagon's corners are cut by 0.29)
+CIRCLE_CUT_RANGE = (0.2, 0.4)
+
+
+def set_curve_mode(mode, vertex_limit=None):
+    """Set how to construct curved shapes: "smooth" or "grid" (grid-snapped
+    polygons with at most vertex_limit vertices).
+    """
+    global curve_mode, curve_vertex_limit
+    if not mode in CURVE_MODES:
+        raise ValueError("Unknown curve mode '{0}'".format(mode))
+    curve_mode = mode
+    if vertex_limit is not None:
+        curve_vertex_limit = vertex_limit
+    log.info("Curved shapes are now {0}".format(mode))
+
+
+def worker_settings():
+    """Get this process's geometry and logging settings, as the arguments
+    to pass to init_worker() in a new worker process"""
+    return ((validation_mode, validation_sample_interval),
+            (curve_mode, curve_vertex_limit),
+            logging.getLogger('aagen').getEffectiveLevel())
+
+
+def init_worker(validation, curves, log_level):
+    """Apply the given settings (see worker_settings()) in a new worker
+    process. The worker may not have inherited our module state (depending
+    on how the platform starts new processes), so they are passed in.
+    """
+    set_validation(*validation)
+    set_curve_mode(*curves)
+    logging.basicConfig()
+    logging.getLogger('aagen').setLevel(log_level)
+
+
 def to_string(geometry):
     """Returns a brief (less precise) representation of a geometric object"""
     if geometry is None:
@@ -47,15 +137,51 @@ def to_string(geometry):
         raise RuntimeError("to_string: unknown object type {0}"
                            .format(geometry))
 
-    str_list = []
-    for (x, y) in coords:
-        str_list.append("({0}, {1})".format(numstr(x), numstr(y)))
     return "<{0}: [{1}]>".format(type(geometry).__name__,
-                              ", ".join(str_list))
+                                 coords_string(coords))
+
+
+# Trailing zeros (and decimal point) of a '%0.2f' number, as numstr() drops
+TRAILING_ZEROS = re.compile(r"\.?0+(?=[,)])")
+
+
+def coords_string(coords):
+    """Format a sequence of (x, y) coordinates as "(x, y), (x, y), ..."
+    with each number formatted as by numstr().
+    """
+    # Format all of the numbers in one go rather than one numstr() at a time
+    flat = []
+    for (x, y) in coords:
+        flat.append(x)
+        flat.append(y)
+    if not flat:
+        return ""
+    text = ("(%0.2f, %0.2f), " * (len(flat) // 2))[:-2] % tuple(flat)
+    return TRAILING_ZEROS.sub("", text)
+
+
+GEOMETRY_STRING = re.compile(r"<(\w+): \[(.*)\]>$")
+COORDS_PAIR = re.compile(r"\(([^,()]+), ([^,()]+)\)")
+GEOMETRY_KINDS = {
+    "LineString": LineString,
+    "Polygon": Polygon,
+}
 
 
 def from_string(string):
     """Convert a string representation back to a list of coordinates"""
+    match = GEOMETRY_STRING.match(string.strip())
+    if match and match.group(1) in GEOMETRY_KINDS:
+        coords_str = match.group(2)
+        try:
+            coords = [(float(x), float(y))
+                      for (x, y) in COORDS_PAIR.findall(coords_str)]
+        except ValueError:
+            coords = None
+        if coords and len(coords) == coords_str.count("("):
+            return GEOMETRY_KINDS[match.group(1)](coords)
+
+    # Anything unusual - fall back to the slow but general approach
     string = string.lstrip("<").rstrip(">")
     (kind, coords_str) = string.split(":")
     coords = ast.literal_eval(coords_str.strip())
@@ -107,19 +233,30 @@ def translate(shape, dx_or_dir, dy_or_dist):
     the given (direction, distance) and return the
     resulting new shape.
     """
-    assert shape.is_valid
+    check = validating()
+    assert not check or shape.is_valid
     if isinstance(dx_or_dir, Direction):
         dx = dx_or_dir.vector[0] * dy_or_dist
         dy = dx_or_dir.vector[1] * dy_or_dist
     else:
         dx = dx_or_dir
         dy = dy_or_dist
-    new_shape = shapely.affinity.translate(shape, dx, dy)
-    if not new_shape.is_valid and isinstance(new_shape, Polygon):
+    shape_type = type(shape)
+    if shape.is_empty or shape.has_z:
+        new_shape = shapely.affinity.translate(shape, dx, dy)
+    elif shape_type is Point or shape_type is LineString:
+        new_shape = shape_type(shift_coords(shape.coords, dx, dy))
+    elif shape_type is Polygon:
+        new_shape = Polygon(shift_coords(shape.exterior.coords, dx, dy),
+                            [shift_coords(ring.coords, dx, dy)
+                             for ring in shape.interiors])
+    else:
+        new_shape = shapely.affinity.translate(shape, dx, dy)
+    if isinstance(new_shape, Polygon) and not new_shape.is_valid:
         log.warning("Polygon {0} no longer valid after translating ({1}, {2})??"
                     .format(to_string(shape), dx, dy))
         new_shape = new_shape.buffer(0)
-    assert new_shape.is_valid, (
+    assert not check or new_shape.is_valid, (
         "Shape {0} was valid, but after translating by ({1}, {2}) the new "
         "shape {3} is not: {4}"
         .format(to_string(shape), dx, dy, to_string(new_shape),
@@ -127,6 +264,14 @@ def translate(shape, dx_or_dir, dy_or_dist):
     return new_shape
 
 
+def shift_coords(coords, dx, dy):
+    """Helper function for translate() and friends.
+    Shift the given (2D) coordinates by (dx, dy), with exactly the same
+    arithmetic as shapely.affinity.translate().
+    """
+    return [(x + 0.0 * y + dx, 0.0 * x + y + dy) for (x, y) in coords]
+
+
 def rotate(geometry, angle):
     """Rotate the given geometry, vector, or list of points by the given angle,
     which can be given in degrees, as a Direction, or as a vector (where east
@@ -137,24 +282,22 @@ def rotate(geometry, angle):
         # (x, y) - box and unbox it as a list of one point
         return rotate([geometry], angle)[0]
     if isinstance(angle, Direction):
-        return rotate(geometry, angle.degrees)
-
-    if type(angle) is tuple:
-        radians = math.atan2(angle[1], angle[0])
-        degrees = math.degrees(radians)
+        degrees = angle.degrees
+        (cos, sin) = angle.rotation
     else:
-        degrees = angle
-        radians = math.radians(degrees)
+        if type(angle) is tuple:
+            radians = math.atan2(angle[1], angle[0])
+            degrees = math.degrees(radians)
+        else:
+            degrees = angle
+            radians = math.radians(degrees)
+        (cos, sin) = (math.cos(radians), math.sin(radians))
 
     if type(geometry) is list or type(geometry) is tuple:
-        output = []
-        for (x0, y0) in geometry:
-            (x1, y1) = (x0 * math.cos(radians) - y0 * math.sin(radians),
-                        x0 * math.sin(radians) + y0 * math.cos(radians))
-            log.debug("({0}, {1}) rotated by {2} degrees is ({3}, {4})"
-                      .format(x0, y0, degrees, x1, y1))
-            output.append((x1, y1))
-        return output
+        log.debug("Rotating {0} points by {1} degrees"
+                  .format(len(geometry), degrees))
+        return [(x0 * cos - y0 * sin, x0 * sin + y0 * cos)
+                for (x0, y0) in geometry]
     else:
         return shapely.affinity.rotate(geometry, degrees)
 
@@ -494,8 +637,17 @@ def point_sweep(point, dx_or_dir, dy_or_dist):
     """Moves the given point and constructs a line segment between the two.
     Returns the constructed line
     """
-    point2 = translate(point, dx_or_dir, dy_or_dist)
-    new_line = line(point, point2)
+    if isinstance(dx_or_dir, Direction):
+        dx = dx_or_dir.vector[0] * dy_or_dist
+        dy = dx_or_dir.vector[1] * dy_or_dist
+    else:
+        dx = dx_or_dir
+        dy = dy_or_dist
+    coords = list(point.coords)
+    new_line = LineString(coords + shift_coords(coords, dx, dy))
+    assert not validating() or new_line.is_valid, (
+        "Sweeping {0} by ({1}, {2}) does not yield a valid line"
+        .format(to_string(point), dx, dy))
     return new_line
 
 
@@ -511,14 +663,65 @@ def sweep(base_line, dir, distance, base_dir=None, width=None):
 
     line2 = translate(line1, dir, distance)
 
-    poly2 = loft(line1, line2)
+    coords = list(line1.coords)
+    if (len(coords) == 2 and
+        ((coords[1][0] - coords[0][0]) * dir.vector[1] !=
+         (coords[1][1] - coords[0][1]) * dir.vector[0]) and distance != 0):
+        # A straight segment swept sideways always yields a parallelogram,
+        # so there's no need for loft() to analyze the general case.
+        poly2 = shapely.ops.cascaded_union(
+            [Polygon(coords + list(reversed(line2.coords)))])
+    else:
+        poly2 = loft(line1, line2)
 
-    log.debug("Swept polygon from {0} to the {1} by {2}: {3}"
-              .format(to_string(line1), dir, distance,
-                      to_string(poly2)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Swept polygon from {0} to the {1} by {2}: {3}"
+                  .format(to_string(line1), dir, distance,
+                          to_string(poly2)))
     return (poly2, line2)
 
 
+def sweep_clearance(base_line, dir, distance, obstacle):
+    """Determine how far (up to the given distance) the given line segment can
+    be swept in the given direction before the swept polygon overlaps the
+    interior of the given obstacle.
+
+    Rather than sweeping and testing the polygon at each candidate distance,
+    this intersects the full-length sweep with the obstacle once and measures
+    how far along the sweep the nearest piece of the overlap begins.
+    Overlapping fragments smaller than SLIVER_AREA are ignored, as are base
+    lines that are not a single straight segment, so the result is an upper
+    bound - a sweep of up to this distance may still be truncated slightly.
+    """
+    assert isinstance(dir, Direction)
+    coords = list(line(base_line).coords)
+    if len(coords) != 2 or distance <= 0:
+        return distance
+    ((ax, ay), (bx, by)) = coords
+    (ux, uy) = (bx - ax, by - ay)
+    (vx, vy) = dir.vector
+    # Sweep distance at point q is cross(u, q - a) / cross(u, v)
+    denominator = ux * vy - uy * vx
+    if denominator == 0:
+        # Sweeping a line along itself doesn't cover any area
+        return distance
+
+    (corridor, _) = sweep(base_line, dir, distance)
+    overlap = corridor.intersection(obstacle)
+    if hasattr(overlap, "geoms"):
+        fragments = list(overlap.geoms)
+    else:
+        fragments = [overlap]
+    clearance = distance
+    for geom in fragments:
+        if not isinstance(geom, Polygon) or geom.area < SLIVER_AREA:
+            continue
+        for (qx, qy) in geom.exterior.coords:
+            clearance = min(clearance,
+                            (ux * (qy - ay) - uy * (qx - ax)) / denominator)
+    return max(clearance, 0)
+
+
 def loft(*args):
     """Construct a polygon from the given linear cross-sections.
        ----               ----_
@@ -534,8 +737,9 @@ def loft(*args):
     while len(lines) > 0:
         line2 = lines.pop(0)
         assert line2.length > 0
-        log.debug("Constructing a polygon between {0} and {1}"
-                  .format(to_string(line1), to_string(line2)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Constructing a polygon between {0} and {1}"
+                      .format(to_string(line1), to_string(line2)))
         poly = None
         # Degenerate cases first
         if line1.crosses(line2):
@@ -581,7 +785,8 @@ def loft(*args):
             if poly1.is_valid:
                 poly = poly1
 
-        log.debug("Constructed {0}".format(to_string(poly)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Constructed {0}".format(to_string(poly)))
         if poly is not None:
             polys.append(poly)
         line1 = line2
@@ -634,12 +839,14 @@ def loft_to_grid(base_line, dir, width):
     candidate_1 = point_sweep(p1, dir.rotate(-90), width)
     candidate_2 = point_sweep(p2, dir.rotate(90), width)
     # TODO - intermediate possibilities?
-    while (sweep(candidate_1, dir, 50)[0].crosses(base_line) or
-           sweep(candidate_1, dir, 50)[0].contains(base_line)):
-        candidate_1 = translate(candidate_1, dir, 10)
-    while (sweep(candidate_2, dir, 50)[0].crosses(base_line) or
-           sweep(candidate_2, dir, 50)[0].contains(base_line)):
-        candidate_2 = translate(candidate_2, dir, 10)
+    # Move each candidate away from the base line until sweeping it 50'
+    # further would no longer overlap the base line
+    steps = loft_clearance(base_line, candidate_1, dir, 50, 10)
+    if steps > 0:
+        candidate_1 = translate(candidate_1, dir, 10 * steps)
+    steps = loft_clearance(base_line, candidate_2, dir, 50, 10)
+    if steps > 0:
+        candidate_2 = translate(candidate_2, dir, 10 * steps)
 
     poly1 = loft(base_line, candidate_1)
     poly2 = loft(base_line, candidate_2)
@@ -661,17 +868,194 @@ def loft_to_grid(base_line, dir, width):
     return (candidate_line, poly)
 
 
+def loft_clearance(base_line, candidate, dir, depth, step):
+    """Helper function for loft_to_grid().
+    Determine the smallest number of steps (of the given size) by which the
+    candidate line must be moved in the given direction so that the region
+    swept by moving it a further 'depth' does not overlap the base line.
+
+    This is calculated directly (and exactly) from the coordinates of the
+    two lines, projected along and across the given direction, rather than
+    by constructing and testing each swept polygon in turn.
+    """
+    (vx, vy) = (Fraction(dir.vector[0]), Fraction(dir.vector[1]))
+    scale = vx * vx + vy * vy
+
+    def project(coord):
+        # (distance along dir, distance across dir)
+        (x, y) = (Fraction(coord[0]), Fraction(coord[1]))
+        return ((x * vx + y * vy) / scale, y * vx - x * vy)
+
+    ((start, b1), (_, b2)) = [project(c) for c in candidate.coords]
+    (b_lo, b_hi) = (min(b1, b2), max(b1, b2))
+
+    # For each segment of the base line, the range of distances along dir
+    # spanned by the part of the segment lying strictly between the
+    # sides of the swept region:
+    spans = []
+    coords = [project(c) for c in base_line.coords]
+    for ((a0, b0), (a1, b1)) in zip(coords[:-1], coords[1:]):
+        if b0 == b1:
+            if b_lo < b0 < b_hi:
+                spans.append((min(a0, a1), max(a0, a1)))
+            continue
+        t1 = (b_lo - b0) / (b1 - b0)
+        t2 = (b_hi - b0) / (b1 - b0)
+        t_lo = max(min(t1, t2), 0)
+        t_hi = min(max(t1, t2), 1)
+        if t_lo >= t_hi:
+            continue
+        a_lo = a0 + t_lo * (a1 - a0)
+        a_hi = a0 + t_hi * (a1 - a0)
+        spans.append((min(a_lo, a_hi), max(a_lo, a_hi)))
+
+    def clear(steps):
+        near = start + steps * step
+        far = near + depth
+        return all(a_hi <= near or a_lo >= far for (a_lo, a_hi) in spans)
+
+    # The answer is either no movement at all, or just enough movement for
+    # the swept region to clear one of the spans entirely
+    options = [0] + sorted(-((start - a_hi) // step) for (_, a_hi) in spans)
+    for steps in options:
+        if steps >= 0 and clear(steps):
+            return steps
+    raise RuntimeError("Unable to clear {0} by moving {1} to the {2}"
+                       .format(to_string(base_line), to_string(candidate),
+                               dir))
+
+
+def is_box(poly):
+    """Returns whether the given polygon is a simple axis-aligned rectangle"""
+    if not isinstance(poly, Polygon) or poly.is_empty or poly.interiors:
+        return False
+    coords = list(poly.exterior.coords)
+    if len(coords) != 5:
+        return False
+    for ((x1, y1), (x2, y2)) in zip(coords[:-1], coords[1:]):
+        if x1 != x2 and y1 != y2:
+            return False
+    (xmin, ymin, xmax, ymax) = poly.bounds
+    return poly.area == (xmax - xmin) * (ymax - ymin)
+
+
+def box_edge_segments(poly, width, direction):
+    """Helper function for find_edge_segments().
+    Directly calculate the edge segments of an axis-aligned rectangle, given
+    as 1-D intervals along the wall(s) facing the given direction.
+
+    Returns the same segments as the general algorithm would, or None if
+    this shortcut doesn't apply - for example, if the rectangle is too small
+    relative to the width, as the general algorithm has its own particular
+    handling of bands that span the entire rectangle.
+    """
+    (xmin, ymin, xmax, ymax) = poly.bounds
+    ccw = poly.exterior.is_ccw
+    segments = []
+
+    def add_segment(coords):
+        # Segments follow the winding direction of the polygon's exterior
+        if not ccw:
+            coords.reverse()
+        segments.append(LineString(coords))
+
+    if direction.is_cardinal():
+        # Bands of the given width step along the wall from the grid line
+        # at or before its start; each band lying within the wall is a hit
+        if direction == Direction.N or direction == Direction.S:
+            (lo, hi) = (xmin, xmax)
+        else:
+            (lo, hi) = (ymin, ymax)
+        if width >= hi - lo:
+            return None
+        start = math.floor(lo / 10) * 10
+        start += 10 * math.ceil((lo - start) / 10)
+        while start + width <= hi:
+            end = start + width
+            if direction == Direction.N:
+                add_segment([(end, ymax), (start, ymax)])
+            elif direction == Direction.S:
+                add_segment([(start, ymin), (end, ymin)])
+            elif direction == Direction.E:
+                add_segment([(xmax, start), (xmax, end)])
+            else:
+                add_segment([(xmin, end), (xmin, start)])
+            start += 10
+        return segments
+
+    # For diagonal directions, the only hits are L-shaped segments wrapping
+    # around the corner in question, one for each diagonal band that
+    # straddles the corner.
+    if width >= min(xmax - xmin, ymax - ymin):
+        return None
+    # The general algorithm finds these by intersecting diagonal lines, so we
+    # can only match its results exactly when the corners lie on whole feet
+    if not all(float(value).is_integer() for value in poly.bounds):
+        return None
+    if direction == Direction.NE or direction == Direction.SW:
+        # Bands are intervals of (x - y), stepping up from the band
+        # starting at the upper left corner of the grid-aligned bounds
+        origin = math.floor(xmin / 10) * 10 - math.ceil(ymax / 10) * 10
+        if direction == Direction.NE:
+            corner = xmax - ymax
+        else:
+            corner = xmin - ymin
+        low = origin + 10 * max(math.ceil((corner - width - origin) / 10), 0)
+        while low < corner:
+            if low + width > corner:
+                if direction == Direction.NE:
+                    add_segment([(xmax, ymax - (low + width - corner)),
+                                 (xmax, ymax),
+                                 (xmax - (corner - low), ymax)])
+                else:
+                    add_segment([(xmin, ymin + (corner - low)),
+                                 (xmin, ymin),
+                                 (xmin + (low + width - corner), ymin)])
+            low += 10
+    else:
+        # Bands are intervals of (x + y), stepping down from the band
+        # ending at the upper right corner of the grid-aligned bounds
+        origin = math.ceil(xmax / 10) * 10 + math.ceil(ymax / 10) * 10
+        if direction == Direction.NW:
+            corner = xmin + ymax
+        else:
+            corner = xmax + ymin
+        high = origin - 10 * max(math.ceil((origin - width - corner) / 10), 0)
+        while high > corner:
+            if high - width < corner:
+                if direction == Direction.NW:
+                    add_segment([(xmin + (high - corner), ymax),
+                                 (xmin, ymax),
+                                 (xmin, ymax - (corner - high + width))])
+                else:
+                    add_segment([(xmax - (corner - high + width), ymin),
+                                 (xmax, ymin),
+                                 (xmax, ymin + (high - corner))])
+            high -= 10
+    return segments
+
+
 def find_edge_segments(poly, width, direction):
     """Find grid-constrained line segments along the border of the given polygon
     in the given direction with the given width.
     Returns a list of zero or more line segments.
     """
 
-    log.info("Finding line segments (width {0}) along the {1} edge of {2}"
-             .format(width, direction, to_string(poly)))
+    if log.isEnabledFor(logging.INFO):
+        log.info("Finding line segments (width {0}) along the {1} edge of {2}"
+                 .format(width, direction, to_string(poly)))
 
     assert isinstance(direction, Direction)
 
+    if is_box(poly):
+        segments = box_edge_segments(poly, width, direction)
+        if segments is not None:
+            if log.isEnabledFor(logging.INFO):
+                log.info("Found {0} candidate edges: {1}"
+                         .format(len(segments),
+                                 [to_string(s) for s in segments]))
+            return segments
+
     border = line_loop(poly.exterior.coords)
 
     (xmin, ymin, xmax, ymax) = poly.bounds
@@ -680,8 +1064,8 @@ def find_edge_segments(poly, width, direction):
         inter_box = box(math.floor(xmin/10)*10, ymin - 10,
                         math.floor(xmin/10)*10 + width, ymax + 10)
         offset = Direction.E
-        def check_width(intersection):
-            w = intersection.bounds[2] - intersection.bounds[0]
+        def check_width(bounds):
+            w = bounds[2] - bounds[0]
             return w >= width
         def check_size(intersection, size):
             # Make sure width matches "size" and height not too much
@@ -702,8 +1086,8 @@ def find_edge_segments(poly, width, direction):
         inter_box = box(xmin - 10, math.floor(ymin/10)*10,
                         xmax + 10, math.floor(ymin/10)*10 + width)
         offset = Direction.N
-        def check_width(intersection):
-            h = intersection.bounds[3] - intersection.bounds[1]
+        def check_width(bounds):
+            h = bounds[3] - bounds[1]
             return h >= width
         def check_size(intersection, size):
             # Make sure height matches "size" and width not too much
@@ -744,9 +1128,8 @@ def find_edge_segments(poly, width, direction):
         inter_box = polygon([point1, point2, point3, point4])
         log.debug("inter_box: {0}".format(to_string(inter_box)))
         offset = Direction.SW
-        def check_width(intersection):
-            l = ((intersection.bounds[2] - intersection.bounds[0]) +
-                 (intersection.bounds[3] - intersection.bounds[1]))
+        def check_width(bounds):
+            l = (bounds[2] - bounds[0]) + (bounds[3] - bounds[1])
             return l >= width
         def check_size(intersection, size):
             w = intersection.bounds[2] - intersection.bounds[0]
@@ -786,9 +1169,8 @@ def find_edge_segments(poly, width, direction):
         inter_box = polygon([point1, point2, point3, point4])
         log.debug("inter_box: {0}".format(to_string(inter_box)))
         offset = Direction.SE
-        def check_width(intersection):
-            l = ((intersection.bounds[2] - intersection.bounds[0]) +
-                 (intersection.bounds[3] - intersection.bounds[1]))
+        def check_width(bounds):
+            l = (bounds[2] - bounds[0]) + (bounds[3] - bounds[1])
             return l >= width
         def check_size(intersection, size):
             w = intersection.bounds[2] - intersection.bounds[0]
@@ -818,7 +1200,8 @@ def find_edge_segments(poly, width, direction):
 
     while True:
         intersection = intersect(inter_box, border)
-        log.debug("intersection: {0}".format(to_string(intersection)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("intersection: {0}".format(to_string(intersection)))
         if intersection.length == 0:
             if not first_hit:
                 # We're not there yet - just move closer
@@ -842,15 +1225,17 @@ def find_edge_segments(poly, width, direction):
         for segment in intersection:
             segments += minimize_line(segment, check_width)
         intersection = segments
-        log.debug("Intersection: {0}"
-                  .format([to_string(x) for x in intersection]))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Intersection: {0}"
+                      .format([to_string(x) for x in intersection]))
 
         for linestring in intersection:
             if best is None or prefer(linestring, best):
                 if best is not None:
-                    log.info("Preferring {0} over {1}"
-                             .format(to_string(linestring),
-                                     to_string(best)))
+                    if log.isEnabledFor(logging.INFO):
+                        log.info("Preferring {0} over {1}"
+                                 .format(to_string(linestring),
+                                         to_string(best)))
                 best = linestring
 
         inter_box = translate(inter_box, offset, 10)
@@ -866,8 +1251,9 @@ def find_edge_segments(poly, width, direction):
         log.info("Found section: {0}".format(to_string(best)))
         candidates.append(best)
 
-    log.info("Found {0} candidate edges: {1}"
-             .format(len(candidates), [to_string(c) for c in candidates]))
+    if log.isEnabledFor(logging.INFO):
+        log.info("Found {0} candidate edges: {1}"
+                 .format(len(candidates), [to_string(c) for c in candidates]))
     return candidates
 
 
@@ -882,12 +1268,14 @@ def trim(shape, trimmer, adjacent_shape):
             isinstance(shape, GeometryCollection)):
         raise TypeError("shape is {0}".format(type(shape)))
 
-    log.debug("Trimming {0} with {1}, adjacent to {2}"
-              .format(to_string(shape), to_string(trimmer),
-                      to_string(adjacent_shape)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Trimming {0} with {1}, adjacent to {2}"
+                  .format(to_string(shape), to_string(trimmer),
+                          to_string(adjacent_shape)))
 
     difference = differ(shape, trimmer)
-    log.debug("Difference is {0}".format(to_string(difference)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Difference is {0}".format(to_string(difference)))
 
     match = None
     # Handle the case where the polygon was split by existing geometry:
@@ -911,19 +1299,40 @@ def trim(shape, trimmer, adjacent_shape):
     if match is not None:
         log.debug("Trimmed shape to fit")
         if match.area > 0:
-            match = match.simplify(0)
-        # TODO? force all coordinates in match to snap to 1' grid
+            match = normalize(match)
     else:
         log.debug("After trimming, shape is nonexistent")
 
     return match
 
 
+def running_bounds(coords):
+    """Helper function for minimize_line().
+    Returns a list of the bounds (xmin, ymin, xmax, ymax) of each successive
+    prefix (coords[:1], coords[:2], ...) of the given coordinate list.
+    """
+    (xmin, ymin) = (xmax, ymax) = coords[0]
+    bounds_list = []
+    for (x, y) in coords:
+        if x < xmin:
+            xmin = x
+        elif x > xmax:
+            xmax = x
+        if y < ymin:
+            ymin = y
+        elif y > ymax:
+            ymax = y
+        bounds_list.append((xmin, ymin, xmax, ymax))
+    return bounds_list
+
+
 def minimize_line(base_line, validator):
     """Trim the given line from both ends to the minimal line(s) that
-    satisfy the given validator function. If the base line does not satisfy
-    the validator, returns a list of this line alone; otherwise, returns
-    a list of 1 or 2 sub-segments that satisfy this criteria.
+    satisfy the given validator function, which is called with the bounds
+    (xmin, ymin, xmax, ymax) of each possible sub-line.
+    If the base line does not satisfy the validator, returns a list of this
+    line alone; otherwise, returns a list of 1 or 2 sub-segments that satisfy
+    this criteria.
 
     For example:
 
@@ -940,38 +1349,37 @@ def minimize_line(base_line, validator):
       '--              |
     """
 
-    if not validator(base_line):
+    coords = list(base_line.coords)
+    last = len(coords) - 1
+    prefixes = running_bounds(coords)
+    suffixes = running_bounds(coords[::-1])
+
+    if not validator(prefixes[last]):
         log.info("Base line {0} does not satisfy validator"
                  .format(to_string(base_line)))
         return [base_line]
 
     # First line: delete from end, then from beginning
-    coords = list(base_line.coords)
-    while (len(coords) > 2):
-        tmp_line = line(coords[:-1])
-        if not validator(tmp_line):
-            break
-        coords = coords[:-1]
-    while (len(coords) > 2):
-        tmp_line = line(coords[1:])
-        if not validator(tmp_line):
-            break
-        coords = coords[1:]
-    line1 = line(coords)
+    end = last
+    while end >= 2 and validator(prefixes[end - 1]):
+        end -= 1
+    # Bounds of each suffix of coords[:end + 1]
+    bounds_list = running_bounds(coords[end::-1])
+    start = 0
+    while end - start >= 2 and validator(bounds_list[end - start - 1]):
+        start += 1
+    line1 = line(coords[start:end + 1])
 
     # Second line: delete from beginning, then from end
-    coords = list(base_line.coords)
-    while (len(coords) > 2):
-        tmp_line = line(coords[1:])
-        if not validator(tmp_line):
-            break
-        coords = coords[1:]
-    while (len(coords) > 2):
-        tmp_line = line(coords[:-1])
-        if not validator(tmp_line):
-            break
-        coords = coords[:-1]
-    line2 = line(coords)
+    start = 0
+    while last - start >= 2 and validator(suffixes[last - start - 1]):
+        start += 1
+    # Bounds of each prefix of coords[start:]
+    bounds_list = running_bounds(coords[start:])
+    end = last
+    while end - start >= 2 and validator(bounds_list[end - start - 1]):
+        end -= 1
+    line2 = line(coords[start:end + 1])
 
     if line1.equals(line2):
         if line1.equals(base_line):
@@ -1010,9 +1418,9 @@ def line(*coords):
     else:
         raise RuntimeError("Don't know how to construct a line segment from {0}"
                            .format(coords))
-    assert line.is_valid, ("{0} does not yield a valid line: {1}"
-                           .format(to_string(coords),
-                                   shapely.validation.explain_validity(line)))
+    assert not validating() or line.is_valid, (
+        "{0} does not yield a valid line: {1}"
+        .format(to_string(coords), shapely.validation.explain_validity(line)))
     return line
 
 
@@ -1021,9 +1429,9 @@ def line_loop(coords):
     (implicitly connecting end and start if needed).
     """
     loop = LinearRing(coords)
-    assert loop.is_valid, ("{0} does not yield a valid line: {1}"
-                           .format(to_string(Coords),
-                                   shapely.validation.explain_validity(loop)))
+    assert not validating() or loop.is_valid, (
+        "{0} does not yield a valid line: {1}"
+        .format(to_string(coords), shapely.validation.explain_validity(loop)))
     return loop
 
 
@@ -1041,9 +1449,9 @@ def polygon(coords=None):
     else:
         raise RuntimeError("Not sure how to create Polygon from {0}"
                            .format(coords))
-    assert poly.is_valid, ("{0} does not yield a valid polygon: {1}"
-                           .format(to_string(coords),
-                                   shapely.validation.explain_validity(poly)))
+    assert not validating() or poly.is_valid, (
+        "{0} does not yield a valid polygon: {1}"
+        .format(to_string(coords), shapely.validation.explain_validity(poly)))
     return poly
 
 
@@ -1088,6 +1496,9 @@ def circle(area):
     """Construct an approximately circular polygon constrained to the grid
     but with approximately the requested area.
     """
+    if curve_mode == CURVE_GRID:
+        return polygon_circle(area)
+
     radius = math.sqrt(area / math.pi)
     log.info("Exact radius would be {0}".format(radius))
 
@@ -1114,48 +1525,120 @@ def circle(area):
     return circle
 
 
+def simple_polygon(coords):
+    """Construct a polygon from the given ring of coordinates, dropping any
+    duplicate or collinear points (including the ring's starting point).
+    """
+    coords = list(coords)
+    if len(coords) > 1 and coords[0] == coords[-1]:
+        coords = coords[:-1]
+    changed = True
+    while changed and len(coords) > 3:
+        changed = False
+        for i in range(len(coords)):
+            (x0, y0) = coords[i - 1]
+            (x1, y1) = coords[i]
+            (x2, y2) = coords[(i + 1) % len(coords)]
+            if (x1 - x0) * (y2 - y1) == (y1 - y0) * (x2 - x1):
+                del coords[i]
+                changed = True
+                break
+    return polygon(coords)
+
+
+def grid_circle(radius, x0=0, y0=0):
+    """Construct a grid-constrained polygon (45-degree angles only)
+    that roughly approximates a circle of the given radius (a multiple of 5)
+    centered at the given point. Uses the midpoint circle algorithm, taking
+    larger steps as needed to stay within curve_vertex_limit vertices.
+
+    For vertices to lie on the 10' grid, (x0 + radius) and (y0 + radius)
+    must be multiples of 10.
+    """
+    # Offset of the grid lines relative to the center
+    first = radius % 10
+    step = 10
+    while True:
+        x = radius
+        y = first
+        point_list = []
+        while x >= y:
+            point_list.append((x, y))
+            # Step "up", then "left" as well if that's closer to the circle
+            y += step
+            if (math.fabs((x - step) ** 2 + y ** 2 - radius ** 2) <
+                math.fabs(x ** 2 + y ** 2 - radius ** 2)):
+                x -= step
+        points = [(x + x0, y + y0) for (x, y) in point_list]
+        points += [(y + x0, x + y0) for (x, y) in reversed(point_list)]
+        points += [(-y + x0, x + y0) for (x, y) in point_list]
+        points += [(-x + x0, y + y0) for (x, y) in reversed(point_list)]
+        points += [(-x + x0, -y + y0) for (x, y) in point_list]
+        points += [(-y + x0, -x + y0) for (x, y) in reversed(point_list)]
+        points += [(y + x0, -x + y0) for (x, y) in point_list]
+        points += [(x + x0, -y + y0) for (x, y) in reversed(point_list)]
+        circ = simple_polygon(points)
+        if (len(circ.exterior.coords) - 1 <= curve_vertex_limit or
+            step >= radius):
+            return circ
+        step *= 2
+
+
 def polygon_circle(area):
     """Construct a grid-constrained polygon (45-degree angles only)
-    that roughly approximates a circle. Uses the midpoint circle algorithm.
+    that roughly approximates a circle with the requested area.
+
+    Any convex polygon with only orthogonal and diagonal edges is an octagon,
+    so we choose the width, height and corner cut (all multiples of 10) whose
+    area is closest to the requested area, keeping the octagon round (see
+    CIRCLE_CUT_RANGE). The width and height may differ by 10', which would
+    otherwise leave large gaps between the areas that can be constructed.
     """
     radius = math.sqrt(area / math.pi)
-    grid_radius = 5 * round(radius/5, 0)
-    log.info("Exact radius would be {0}; rounded to {1}"
-             .format(radius, grid_radius))
-    if grid_radius % 10 == 0:
-        # For even radius, center around a grid intersection
-        x0 = y0 = 0
-    else:
-        # For odd radius, center around a grid square
-        x0 = y0 = 5
-    x = grid_radius
-    y = 0
-    error = 10 - x
-    point_list = []
-    while x >= y:
-        point_list.append((x, y))
-        if error < 0:
-            y += 10
-            error += 2 * y + 10
-        else:
-            y += 10
-            x -= 10
-            error += 2 * (y - x + 10)
-    points = [(x + x0, y + y0) for (x, y) in point_list]
-    points += [(y + x0, x + y0) for (x, y) in reversed(point_list)]
-    points += [(-y + x0, x + y0) for (x, y) in point_list]
-    points += [(-x + x0, y + y0) for (x, y) in reversed(point_list)]
-    points += [(-x + x0, -y + y0) for (x, y) in point_list]
-    points += [(-y + x0, -x + y0) for (x, y) in reversed(point_list)]
-    points += [(y + x0, -x + y0) for (x, y) in point_list]
-    points += [(x + x0, -y + y0) for (x, y) in reversed(point_list)]
-    circ = Polygon(points)
+    (low, high) = CIRCLE_CUT_RANGE
+    best = None
+    for width in range(10, int(3 * radius) + 20, 10):
+        for height in (width, width + 10):
+            if curve_vertex_limit < 8:
+                # No corners can be cut at all
+                cuts = [0]
+            elif width == height and width <= 20:
+                # Too small to look round anyway - a square or a diamond
+                cuts = [0, width // 2]
+            else:
+                cuts = [cut for cut in range(10, width, 10)
+                        if low * width <= cut <= high * width]
+            for cut in cuts:
+                # Prefer the closest area, then an unstretched circle, then
+                # the most regular octagon
+                score = (math.fabs(width * height - 2 * cut * cut - area),
+                         height - width,
+                         math.fabs(float(cut) / width - 0.293))
+                if best is None or score < best[0]:
+                    best = (score, width, height, cut)
+    (_, width, height, cut) = best
+    # Place the vertices on the 10' grid, as near as possible to the origin
+    (x0, y0) = (-10 * (width // 20), -10 * (height // 20))
+    (x1, y1) = (x0 + width, y0 + height)
+    circ = simple_polygon([(x0 + cut, y0), (x1 - cut, y0), (x1, y0 + cut),
+                           (x1, y1 - cut), (x1 - cut, y1), (x0 + cut, y1),
+                           (x0, y1 - cut), (x0, y0 + cut)])
+    log.info("Exact radius would be {0}; constructed {1}"
+             .format(radius, to_string(circ)))
     log.debug("Circle with area {0}: {1}".format(area, to_string(circ)))
     return circ
 
 
 def circle_list(area):
-    return [circle(area)]
+    """Returns the list of possible circles with approximately the
+    requested area (in grid mode, both orientations of any circle that
+    is slightly stretched to better match the area).
+    """
+    circ = circle(area)
+    (xmin, ymin, xmax, ymax) = circ.bounds
+    if curve_mode == CURVE_GRID and xmax - xmin != ymax - ymin:
+        return [circ, shapely.affinity.rotate(circ, 90, origin=(0, 0))]
+    return [circ]
 
 
 def isosceles_right_triangle(area):
@@ -1288,6 +1771,17 @@ def oval_list(area, rotate=True):
             offset = 0
         else:
             offset = 5
+        if curve_mode == CURVE_GRID:
+            # Two grid-constrained circles joined by a rectangle
+            oval = simple_polygon(union(
+                grid_circle(h/2, offset, offset),
+                grid_circle(h/2, w + offset, offset),
+                box(offset, -h/2 + offset, w + offset, h/2 + offset))
+                                  .exterior.coords)
+            ovals.append(oval)
+            if rotate:
+                ovals.append(shapely.affinity.rotate(oval, 90, origin=(0,0)))
+            continue
         circle = point(w - 0.01 + offset, offset).buffer(h/2, resolution=16)
         # circle is a set of (16 * 4 + 1) points counterclockwise from (x, 0)
         left_arc = line([(offset, -h/2 + offset)] +
@@ -1372,6 +1866,158 @@ def octagon_list(area):
     return [octagon]
 
 
+# Geometric identity
+
+# Number of decimal places that coordinates are rounded to in canonical_key()
+KEY_PRECISION = 6
+
+
+def canonical_key(geometry, origin=(0, 0)):
+    """Construct a hashable key for the given geometry such that any two
+    geometries with the same vertices have the same key, regardless of which
+    vertex each ring starts from or which direction it is wound in.
+    Coordinates are taken relative to the given origin and rounded to
+    KEY_PRECISION decimal places.
+    """
+    (x0, y0) = origin
+
+    def coords_key(coords):
+        return tuple((round(x - x0, KEY_PRECISION),
+                      round(y - y0, KEY_PRECISION)) for (x, y) in coords)
+
+    def ring_key(ring):
+        coords = coords_key(ring.coords[:-1])
+        if not coords:
+            return coords
+        options = []
+        for sequence in (coords, coords[::-1]):
+            start = sequence.index(min(sequence))
+            options.append(sequence[start:] + sequence[:start])
+        return min(options)
+
+    if hasattr(geometry, "geoms"):
+        return (geometry.geom_type,
+                tuple(sorted(canonical_key(geom, origin)
+                             for geom in geometry.geoms)))
+    elif isinstance(geometry, Polygon):
+        if geometry.is_empty:
+            return (geometry.geom_type, ())
+        return (geometry.geom_type, ring_key(geometry.exterior),
+                tuple(sorted(ring_key(ring) for ring in geometry.interiors)))
+    else:
+        return (geometry.geom_type, coords_key(geometry.coords))
+
+
+# Normalization
+# Repeated unions, differences and simplifications leave behind vertices that
+# are a hair off the grid, collinear or duplicate vertices, and slivers.
+# These never go away on their own, so we clean them up after each operation
+# that mutates a long-lived polygon.
+
+# Coordinates within this distance of a whole number of feet are snapped to it
+SNAP_TOLERANCE = 0.001
+# Vertices where the (doubled) area of the triangle formed with the adjacent
+# vertices is below this are considered collinear
+COLLINEAR_TOLERANCE = 0.001
+# Holes and polygon fragments with less than this area are discarded
+SLIVER_AREA = 1.0
+
+
+def snap(value):
+    """Snap the given coordinate value to the 1' grid if it's very close"""
+    rounded = round(value)
+    if math.fabs(value - rounded) < SNAP_TOLERANCE:
+        return rounded
+    return value
+
+
+def normalize_ring(coords):
+    """Helper function for normalize().
+    Snap the given ring of coordinates to the grid and remove any duplicate
+    or collinear points (including zero-width spikes).
+    Returns the list of remaining coordinates (without repeating the first
+    coordinate at the end), which may be fewer than 3 if the ring collapses.
+    """
+    def collinear(p0, p1, p2):
+        return (math.fabs((p1[0] - p0[0]) * (p2[1] - p1[1]) -
+                          (p1[1] - p0[1]) * (p2[0] - p1[0])) <
+                COLLINEAR_TOLERANCE)
+
+    points = []
+    for (x, y) in coords[:-1]:
+        point = (snap(x), snap(y))
+        if points and point == points[-1]:
+            continue
+        while len(points) >= 2 and collinear(points[-2], points[-1], point):
+            points.pop()
+        points.append(point)
+    # Repeat the same check where the end of the ring meets the start
+    changed = True
+    while changed and len(points) >= 3:
+        changed = False
+        if points[-1] == points[0]:
+            points.pop()
+            changed = True
+        elif collinear(points[-2], points[-1], points[0]):
+            points.pop()
+            changed = True
+        elif collinear(points[-1], points[0], points[1]):
+            points.pop(0)
+            changed = True
+    return points
+
+
+def normalize(geometry):
+    """Clean up the given polygonal geometry by snapping it to the grid,
+    removing redundant vertices, and discarding slivers.
+    Non-polygonal geometry, or geometry that would not remain valid after
+    normalization, is returned unchanged.
+    """
+    if isinstance(geometry, Polygon):
+        if geometry.is_empty:
+            return geometry
+        exterior = normalize_ring(geometry.exterior.coords)
+        if len(exterior) < 3:
+            log.info("{0} collapsed during normalization"
+                     .format(to_string(geometry)))
+            return geometry
+        interiors = []
+        for ring in geometry.interiors:
+            interior = normalize_ring(ring.coords)
+            if len(interior) >= 3 and Polygon(interior).area >= SLIVER_AREA:
+                interiors.append(interior)
+        new_geometry = Polygon(exterior, interiors)
+    elif isinstance(geometry, MultiPolygon):
+        polygons = [normalize(geom) for geom in geometry.geoms
+                    if geom.area >= SLIVER_AREA]
+        if not polygons:
+            return geometry
+        elif len(polygons) == 1:
+            new_geometry = polygons[0]
+        else:
+            new_geometry = MultiPolygon(polygons)
+    else:
+        return geometry
+
+    if not new_geometry.is_valid:
+        log.info("Normalizing {0} would make it invalid"
+                 .format(to_string(geometry)))
+        return geometry
+    return new_geometry
+
+
+def vertex_count(geometry):
+    """Count the number of distinct vertices in the given geometry"""
+    if hasattr(geometry, "geoms"):
+        return sum(vertex_count(geom) for geom in geometry.geoms)
+    elif isinstance(geometry, Polygon):
+        if geometry.is_empty:
+            return 0
+        return sum(len(ring.coords) - 1 for ring in
+                   [geometry.exterior] + list(geometry.interiors))
+    return len(geometry.coords)
+
+
 # Geometric interaction
 
 def union(*args):
@@ -1391,7 +2037,8 @@ def intersect(geometry_1, geometry_2):
     intersection = geometry_1.intersection(geometry_2)
     if intersection.is_empty:
         return intersection
-    log.debug("Naive intersection is {0}".format(to_string(intersection)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Naive intersection is {0}".format(to_string(intersection)))
 
     if intersection.area == 0 and intersection.length > 0:
         # Intersection is a line segment(s)
@@ -1420,16 +2067,20 @@ def differ(geometry_1, geometry_2):
     difference = geometry_1.difference(geometry_2)
     if difference.is_empty:
         return difference
-    log.debug("Naive difference is {0}".format(to_string(difference)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Naive difference is {0}".format(to_string(difference)))
 
     if difference.area > 0 and not difference.is_valid:
         # The resulting polygon may be overly complex - simplify it
         # if we can.
         difference = difference.buffer(0)
-        log.debug("Cleaned up difference is {0}".format(to_string(difference)))
-
-    assert difference.is_valid, ("difference of {0} and {1} is not valid: {2}"
-                                 .format(to_string(geometry_1),
-                                         to_string(geometry_2),
-                            shapely.validation.explain_validity(difference)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Cleaned up difference is {0}"
+                      .format(to_string(difference)))
+
+    assert not validating() or difference.is_valid, (
+        "difference of {0} and {1} is not valid: {2}"
+        .format(to_string(geometry_1), to_string(geometry_2),
+                shapely.validation.explain_validity(difference)))
     return difference
+
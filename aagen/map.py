@@ -16,14 +16,75 @@
 import logging
 import math
 import re
+import threading
 from itertools import count
 
 import aagen.geometry
+import aagen.raster
+import aagen.walls
 from aagen.geometry import to_string
 from aagen.direction import Direction
 
 log = logging.getLogger(__name__)
 
+# Each DungeonMap numbers its own MapElements, so that a given seed produces
+# the same IDs (and thus the same ordering and output) no matter what else is
+# happening in this process. New MapElements take their IDs from whichever map
+# is active in the current thread (see DungeonMap.activate()), or from a
+# process-wide counter if no map is active (e.g., when loading a map file).
+_active = threading.local()
+
+FOOTPRINT_MARGIN = 500
+"""Distance (in feet) beyond a DungeonMap's footprint out to which the space
+outside the footprint is treated as already occupied. This must exceed the
+size of any Region that the generator might try to place."""
+
+
+def parse_footprint(spec):
+    """Parse a footprint specification - either a size such as "400x300"
+    (a rectangle of that many feet, centered on the entrance) or a polygon
+    in the form produced by aagen.geometry.to_string().
+    """
+    match = re.match(r"^\s*(\d+)\s*[xX]\s*(\d+)\s*$", spec)
+    if match:
+        # Keep the edges on the 10' grid
+        (half_w, half_h) = [int(value) // 20 * 10 for value in match.groups()]
+        if not half_w or not half_h:
+            raise ValueError("Footprint '{0}' is too small".format(spec))
+        return aagen.geometry.box(-half_w, -half_h, half_w, half_h)
+    try:
+        footprint = aagen.geometry.from_string(spec)
+    except Exception:
+        footprint = None
+    if footprint is None or footprint.geom_type != 'Polygon':
+        raise ValueError("Invalid footprint '{0}'".format(spec))
+    return footprint
+
+
+def new_element_id():
+    """Allocate an ID for a new MapElement"""
+    dungeon_map = getattr(_active, 'dungeon_map', None)
+    if dungeon_map is None:
+        return MapElement._ids.next()
+    return dungeon_map.new_element_id()
+
+
+class ActiveMap:
+    """Context manager to make the given DungeonMap the active one in this
+    thread for the duration."""
+
+    def __init__(self, dungeon_map):
+        self.dungeon_map = dungeon_map
+
+    def __enter__(self):
+        self.previous = getattr(_active, 'dungeon_map', None)
+        _active.dungeon_map = self.dungeon_map
+        return self.dungeon_map
+
+    def __exit__(self, *args):
+        _active.dungeon_map = self.previous
+
+
 class SortedSet:
     """A container class for a set of objects that is always ordered by
     object's self-declared ID. Needed for consistent random dungeon generation.
@@ -66,16 +127,76 @@ class DungeonMap:
 
     _ids = count(0)
 
-    def __init__(self):
-        """Initialize a new empty DungeonMap"""
+    def __init__(self, footprint=None):
+        """Initialize a new empty DungeonMap.
+        If a footprint polygon is given, the map may not extend beyond it.
+        """
         self.regions = SortedSet()
         self.connections = SortedSet()
         self.decorations = SortedSet()
         self.conglomerate_polygon = aagen.geometry.polygon()
+        self.occupancy = aagen.raster.OccupancyGrid()
+        self.wall_indexes = {}
+        # Bounds of each change to the map geometry, in order
+        # (None for a change that may affect the whole map)
+        self.changes = []
+        # Next ID to assign to a MapElement created for this map
+        self.next_element_id = 0
         self.id = self._ids.next()
+        self.set_footprint(footprint)
         log.debug("Initialized {0}".format(self))
 
 
+    def activate(self):
+        """Make this the active map in the current thread, for use with
+        the 'with' statement. MapElements created while a map is active
+        are numbered by that map.
+        """
+        return ActiveMap(self)
+
+
+    def set_footprint(self, footprint):
+        """Confine the map to the given footprint polygon (or lift any such
+        confinement, if None). The space surrounding the footprint is treated
+        as already occupied, so new Regions are trimmed to fit within it and
+        no Connections lead out of it.
+        """
+        self.footprint = footprint
+        if footprint is None:
+            self.exterior = None
+        else:
+            (xmin, ymin, xmax, ymax) = footprint.bounds
+            self.exterior = aagen.geometry.differ(
+                aagen.geometry.box(xmin - FOOTPRINT_MARGIN,
+                                   ymin - FOOTPRINT_MARGIN,
+                                   xmax + FOOTPRINT_MARGIN,
+                                   ymax + FOOTPRINT_MARGIN),
+                footprint)
+        self.refresh_conglomerate()
+
+
+    def leaves_footprint(self, line):
+        """Check whether the given line lies along (or beyond) the edge of
+        this map's footprint, such that a Connection there would lead
+        out of it."""
+        if self.exterior is None:
+            return False
+        return aagen.geometry.intersect(line, self.exterior).length > 0
+
+
+    def new_element_id(self):
+        element_id = self.next_element_id
+        self.next_element_id += 1
+        return element_id
+
+
+    def claim_element_id(self, element):
+        """Make sure that this map will not assign the given element's ID
+        to any other MapElement (in case it was numbered elsewhere)."""
+        if element.id >= self.next_element_id:
+            self.next_element_id = element.id + 1
+
+
     def __repr__(self):
         return ("<DungeonMap {4}: {0} regions, "
                 "{1} connections ({2} incomplete), "
@@ -142,10 +263,17 @@ class DungeonMap:
                                    .format(elem))
 
 
-    def add_region(self, region):
+    def add_region(self, region, refresh=True):
+        """Add the given Region (and its connections and decorations).
+
+        When adding many regions at once, such as when loading a map, pass
+        refresh=False and call refresh_conglomerate() once at the end instead.
+        """
         assert isinstance(region, Region)
         if not region in self.regions:
-            log.info("Adding Region ({0}) to {1}".format(region, self))
+            self.claim_element_id(region)
+            if log.isEnabledFor(logging.INFO):
+                log.info("Adding Region ({0}) to {1}".format(region, self))
             inter = aagen.geometry.intersect(region.polygon,
                                              self.conglomerate_polygon)
             if inter.area > 0:
@@ -153,46 +281,118 @@ class DungeonMap:
                 log.error("Trying to add {0} intersects existing map: {1}"
                           .format(region, to_string(inter)))
             self.regions.add(region)
-            self.refresh_conglomerate()
+            if refresh:
+                self.refresh_conglomerate(region)
             for decoration in region.decorations:
                 self.add_decoration(decoration)
             for connection in region.connections:
                 self.add_connection(connection)
             # Look for any existing connections to fix up
             for connection in self.get_incomplete_connections():
-                log.debug("Checking {0} for intersection with {1}"
-                         .format(connection, region))
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Checking {0} for intersection with {1}"
+                              .format(connection, region))
                 if (connection.polygon.intersects(region.polygon) and
                     not connection.polygon.touches(region.polygon)):
                     # TODO fix up any funky edges
                     connection.add_region(region)
                     self.add_connection(connection)
 
-    def refresh_conglomerate(self):
-        """Regenerate the conglomerate polygon.
+    def refresh_conglomerate(self, region=None):
+        """Regenerate the conglomerate polygon and occupancy grid.
+        If a region (or a list of regions) is specified, it is assumed that
+        only these Regions have been added or grown since the last refresh.
+
+        The occupied polygon is the conglomerate polygon plus the space
+        outside the map's footprint (if any), and is what new geometry
+        must not overlap.
         """
         polygons = [r.polygon for r in self.regions]
-        self.conglomerate_polygon = aagen.geometry.union(polygons)
+        self.conglomerate_polygon = aagen.geometry.normalize(
+            aagen.geometry.union(polygons))
+        if self.exterior is None:
+            self.occupied_polygon = self.conglomerate_polygon
+        else:
+            self.occupied_polygon = aagen.geometry.union(
+                self.conglomerate_polygon, self.exterior)
+        if log.isEnabledFor(logging.INFO):
+            log.info("Map complexity: {0}".format(self.vertex_counts()))
+        if region is None:
+            self.occupancy.clear()
+            if self.exterior is not None:
+                self.occupancy.add(self.exterior)
+            for polygon in polygons:
+                self.occupancy.add(polygon)
+            self.changes.append(None)
+        else:
+            if isinstance(region, Region):
+                region = [region]
+            for changed in region:
+                self.occupancy.add(changed.polygon)
+                self.changes.append(changed.bounds)
+
+
+    def version_near(self, bounds):
+        """Get a version number for the map geometry within the given
+        (xmin, ymin, xmax, ymax) bounds. This number changes whenever a Region
+        touching these bounds is added or grown, but is unaffected by changes
+        elsewhere in the map.
+        """
+        (xmin, ymin, xmax, ymax) = bounds
+        for i in reversed(range(len(self.changes))):
+            change = self.changes[i]
+            if (change is None or
+                (change[0] <= xmax and change[2] >= xmin and
+                 change[1] <= ymax and change[3] >= ymin)):
+                return i + 1
+        return 0
+
+
+    def vertex_counts(self):
+        """Report the complexity of the map geometry.
+        Returns a dict of the number of vertices in the conglomerate polygon,
+        in all regions combined, and in the single most complex region.
+        """
+        region_counts = [aagen.geometry.vertex_count(r.polygon)
+                         for r in self.regions]
+        return {
+            'conglomerate': aagen.geometry.vertex_count(
+                self.conglomerate_polygon),
+            'regions': sum(region_counts),
+            'max_region': max(region_counts) if region_counts else 0,
+        }
 
 
     def add_decoration(self, dec):
         assert isinstance(dec, Decoration)
         if not dec in self.decorations:
-            log.info("Adding {0} to {1}".format(dec, self))
+            if log.isEnabledFor(logging.INFO):
+                log.info("Adding {0} to {1}".format(dec, self))
+            self.claim_element_id(dec)
             self.decorations.add(dec)
 
 
     def add_connection(self, connection):
         assert isinstance(connection, Connection)
         if not connection in self.connections:
-            log.info("Adding {0} to {1}".format(connection, self))
+            if log.isEnabledFor(logging.INFO):
+                log.info("Adding {0} to {1}".format(connection, self))
+            self.claim_element_id(connection)
             self.connections.add(connection)
             for region in connection.regions:
                 self.add_region(region)
             # Look for any existing regions to fix up
+            # (a Connection's polygon is swept from its line, so it covers
+            # the line as well)
+            (cxmin, cymin, cxmax, cymax) = connection.bounds
             for region in self.regions:
-                log.debug("Checking {0} for intersection with {1}"
-                          .format(connection, region))
+                (rxmin, rymin, rxmax, rymax) = region.bounds
+                if (rxmin > cxmax or rxmax < cxmin or
+                    rymin > cymax or rymax < cymin):
+                    continue
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Checking {0} for intersection with {1}"
+                              .format(connection, region))
                 if (region.polygon.intersection(connection.line)
                     .equals(connection.line) or
                     (connection.polygon.intersects(region.polygon) and
@@ -317,6 +517,24 @@ class DungeonMap:
         return ((x0, y0), (pos_x, pos_y), (shift_x, shift_y))
 
 
+    def wall_index(self, region):
+        """Get the WallIndex for the given region, constructing a new one
+        if the region, its connections, or the map geometry around it have
+        changed since the last time it was requested.
+        """
+        signature = (region.polygon, self.version_near(region.bounds),
+                     list(region.connections))
+        if region in self.wall_indexes:
+            (old_signature, index) = self.wall_indexes[region]
+            if (old_signature[0] is signature[0] and
+                old_signature[1] == signature[1] and
+                old_signature[2] == signature[2]):
+                return index
+        index = aagen.walls.WallIndex(region, self.regions)
+        self.wall_indexes[region] = (signature, index)
+        return index
+
+
     def find_options_for_connection(self, width, region, direction,
                                     new_only=True, allow_rotation=True):
         """Find valid positional options (if any) for placing a Connection
@@ -340,6 +558,7 @@ class DungeonMap:
             log.debug("Evaluating candidate segment: {0}"
                           .format(to_string(segment)))
             valid = True
+            free = None
             if aagen.geometry.grid_aligned(segment, direction):
                 conn_poly = aagen.geometry.polygon()
             elif Direction.normal_to(segment).angle_from(direction) == 90:
@@ -356,12 +575,22 @@ class DungeonMap:
                 # as can happen when there is a diagonal passage nearby:
                 if aagen.geometry.intersect(
                         conn_poly,
-                        aagen.geometry.differ(self.conglomerate_polygon,
+                        aagen.geometry.differ(self.occupied_polygon,
                                               region.polygon)).area > 0:
                     log.debug("Overflows into existing space - invalid")
                     valid = False
 
-            if valid:
+            if valid and self.leaves_footprint(segment):
+                log.debug("Leads out of the map footprint - invalid")
+                valid = False
+
+            if valid and conn_poly.is_empty:
+                # Grid-aligned segments along the region's own walls can be
+                # checked quickly against the index of blocked wall space
+                free = self.wall_index(region).is_free(segment, new_only)
+                if free is not None:
+                    valid = free
+            if valid and free is None:
                 # Make sure it doesn't intersect any existing conns
                 for conn in region.connections:
                     if aagen.geometry.intersect(conn.line, segment).length > 0:
@@ -369,7 +598,7 @@ class DungeonMap:
                                   .format(conn))
                         valid = False
                         break
-            if valid and new_only:
+            if valid and free is None and new_only:
                 # Make sure it doesn't intersect any other regions
                 for test_region in self.regions:
                     if test_region == region:
@@ -397,19 +626,23 @@ class DungeonMap:
         return candidates
 
 
-    def find_options_for_region(self, shape_list, connection):
+    def find_options_for_region(self, shape_list, connection,
+                                truncation_epsilon=None):
         """Find valid positional options (if any) for placing one of the
         given shapes adjacent to the given Connection.
+        If truncation_epsilon is set, options that are truncated by more than
+        this amount compared to the least-truncated option may be omitted.
         Returns a list of Candidate_Region objects"""
 
         direction = connection.direction
 
         width = connection.size()
 
-        log.info("Looking for positional options for region(s) {0} "
-                 "adjacent to {1} in {2}"
-                 .format([to_string(c) for c in shape_list],
-                         to_string(connection.line), direction))
+        if log.isEnabledFor(logging.INFO):
+            log.info("Looking for positional options for region(s) {0} "
+                     "adjacent to {1} in {2}"
+                     .format([to_string(c) for c in shape_list],
+                             to_string(connection.line), direction))
 
         # Our approach is as follows:
         # For each of the candidate shapes in shape_list:
@@ -418,8 +651,25 @@ class DungeonMap:
         #     Shift the candidate shape so this edge aligns with the conn
         #     Evaluate the fit of this possible position
 
-        candidate_regions = []
+        placements = []
+        # Shapes that are identical (e.g. rotations of a symmetric shape)
+        # up to a grid-aligned translation will have identical placements
+        shape_placements = {}
         for polygon in shape_list:
+            (xmin, ymin, _, _) = polygon.bounds
+            origin = (math.floor(xmin / 10) * 10, math.floor(ymin / 10) * 10)
+            shape_key = aagen.geometry.canonical_key(polygon, origin)
+            if shape_key in shape_placements:
+                log.info("{0} is identical to an earlier shape"
+                         .format(to_string(polygon)))
+                (first_origin, first_placements) = shape_placements[shape_key]
+                (tx, ty) = (origin[0] - first_origin[0],
+                            origin[1] - first_origin[1])
+                placements += [((dx - tx, dy - ty), test_polygon) for
+                               ((dx, dy), test_polygon) in first_placements]
+                continue
+            first_placement = len(placements)
+
             log.info("Looking for positional options for {0}"
                      .format(to_string(polygon)))
 
@@ -466,19 +716,172 @@ class DungeonMap:
                         test_polygon,
                         aagen.geometry.translate(edge_poly, dx, dy))
                 log.info("test_polygon: {0}".format(to_string(test_polygon)))
-                trim_polygon = aagen.geometry.trim(test_polygon,
-                                                   self.conglomerate_polygon,
-                                                   connection.polygon)
+                placements.append(((dx, dy), test_polygon))
+
+            shape_placements[shape_key] = (origin,
+                                           placements[first_placement:])
+
+        # Different edges and shapes frequently result in identical
+        # placements - only evaluate the first of each such set.
+        # The others still get their own candidate afterwards, so as not to
+        # change the relative weights of the options we find.
+        first_placements = {}
+        duplicates = {}
+        for (i, (_, test_polygon)) in enumerate(placements):
+            key = aagen.geometry.canonical_key(test_polygon)
+            if key in first_placements:
+                duplicates[i] = first_placements[key]
+            else:
+                first_placements[key] = i
+        if duplicates:
+            log.info("{0} of {1} placements are duplicates"
+                     .format(len(duplicates), len(placements)))
+
+        # Broad phase: the occupancy grid gives us a cheap lower bound on how
+        # much each placement will be truncated by the existing map.
+        # Evaluate the most promising placements first so that we can skip
+        # the exact evaluation of any that cannot possibly be competitive.
+        lower_bounds = {}
+        for i in first_placements.values():
+            lower_bounds[i] = round(
+                self.occupancy.overlap_area(placements[i][1]))
+        order = sorted(lower_bounds.keys(), key=lambda i: (lower_bounds[i], i))
+        results = [None] * len(placements)
+        best = None
+        while order:
+            # Evaluate together all remaining placements that may still be
+            # competitive with the best candidate found so far
+            if truncation_epsilon is None:
+                tier = order
+            else:
+                if best is None:
+                    limit = lower_bounds[order[0]] + truncation_epsilon
+                else:
+                    limit = best + truncation_epsilon
+                tier = [i for i in order if lower_bounds[i] <= limit]
+                if not tier:
+                    log.info("Skipping remaining placements - all would be "
+                             "truncated by at least {0}"
+                             .format(lower_bounds[order[0]]))
+                    break
+            order = order[len(tier):]
+
+            trimmed = []
+            for i in tier:
+                trim_polygon = aagen.geometry.trim(
+                    placements[i][1], self.occupied_polygon,
+                    connection.polygon)
                 if trim_polygon is None:
                     log.info("Polygon trimmed to nothing!")
-                    continue
-                cr = self.make_candidate_region((dx, dy), # TODO
-                                                test_polygon, trim_polygon)
+                else:
+                    trimmed.append((i, trim_polygon))
+            crs = self.make_candidate_regions(
+                [placements[i][0] for (i, _) in trimmed],
+                [placements[i][1] for (i, _) in trimmed],
+                [trim_polygon for (_, trim_polygon) in trimmed])
+            for ((i, _), cr) in zip(trimmed, crs):
                 if cr is not None: # TODO
                     log.info("Found a match at ({x}, {y})"
-                             .format(x=dx, y=dy))
-                    candidate_regions.append(cr)
+                             .format(x=placements[i][0][0],
+                                     y=placements[i][0][1]))
+                    results[i] = cr
+                    if best is None or round(cr.amount_truncated) < best:
+                        best = round(cr.amount_truncated)
+
+        for (i, first) in duplicates.items():
+            cr = results[first]
+            if cr is not None:
+                results[i] = Candidate_Region(placements[i][0], cr.polygon,
+                                              cr.connections,
+                                              cr.amount_truncated,
+                                              cr.shared_walls)
+
+        # Preserve the original ordering of the candidates
+        candidate_regions = [cr for cr in results if cr is not None]
+        log.info("Found {0} candidate regions".format(len(candidate_regions)))
+        return candidate_regions
+
+
+    def find_placements_for_region(self, shape_list, connection, top_k):
+        """Find positional options for placing one of the given shapes
+        adjacent to the given Connection, by searching every grid-aligned
+        position at once on the occupancy grid rather than trying each
+        edge of each shape in turn.
+
+        Positions are ranked by their (raster) overlap with the existing map,
+        then by how much wall they share with it; only the top_k positions
+        are then evaluated exactly.
 
+        Returns a list of Candidate_Region objects, or None if this search
+        cannot be applied to the given Connection (in which case use
+        find_options_for_region() instead).
+        """
+        direction = connection.direction
+        cell = self.occupancy.cell
+        step = 10 // cell
+        if not direction.is_cardinal():
+            return None
+        if [b for b in connection.line.bounds if b % cell != 0]:
+            return None
+        (c0, r0, c1, r1) = [int(b // cell) for b in connection.line.bounds]
+
+        # Cells immediately in front of the connection must be covered by
+        # the new region, and those immediately behind it must not be
+        (dx, dy) = direction.vector
+        if dx == 0:
+            (front, behind) = (r0, r0 - 1) if dy > 0 else (r0 - 1, r0)
+            front_cells = [(c, front) for c in range(c0, c1)]
+            behind_cells = [(c, behind) for c in range(c0, c1)]
+        else:
+            (front, behind) = (c0, c0 - 1) if dx > 0 else (c0 - 1, c0)
+            front_cells = [(front, r) for r in range(r0, r1)]
+            behind_cells = [(behind, r) for r in range(r0, r1)]
+        (anchor_col, anchor_row) = front_cells[0]
+
+        log.info("Searching all placements of {0} shapes adjacent to {1}"
+                 .format(len(shape_list), connection))
+
+        options = []
+        for (index, polygon) in enumerate(shape_list):
+            (offset, rows) = aagen.raster.rasterize(polygon, cell)
+            shape_cells = aagen.raster.cells(rows, offset)
+            occupied = set(shape_cells)
+            (halo_offset, halo_rows) = aagen.raster.halo(offset, rows)
+            # Each possible placement maps some cell of the shape onto the
+            # first cell in front of the connection
+            for (c, r) in shape_cells:
+                (dc, dr) = (anchor_col - c, anchor_row - r)
+                if dc % step != 0 or dr % step != 0:
+                    continue
+                if [1 for (fc, fr) in front_cells
+                    if (fc - dc, fr - dr) not in occupied]:
+                    continue
+                if [1 for (bc, br) in behind_cells
+                    if (bc - dc, br - dr) in occupied]:
+                    continue
+                overlap = self.occupancy.overlap_count(offset, rows, dc, dr)
+                contact = self.occupancy.overlap_count(halo_offset, halo_rows,
+                                                       dc, dr)
+                options.append((overlap, -contact, index, dc, dr))
+
+        options.sort()
+        log.info("Found {0} possible placements; evaluating the best {1}"
+                 .format(len(options), min(top_k, len(options))))
+        options = options[:top_k]
+
+        offsets = [(dc * cell, dr * cell) for (_, _, _, dc, dr) in options]
+        test_polygons = [aagen.geometry.translate(shape_list[index], x, y)
+                         for ((_, _, index, _, _), (x, y))
+                         in zip(options, offsets)]
+        trim_polygons = [aagen.geometry.trim(polygon, self.occupied_polygon,
+                                             connection.polygon)
+                         for polygon in test_polygons]
+        trimmed = [i for (i, trim_polygon) in enumerate(trim_polygons)
+                   if trim_polygon is not None]
+        crs = self.make_candidate_regions([offsets[i] for i in trimmed],
+                                          [test_polygons[i] for i in trimmed],
+                                          [trim_polygons[i] for i in trimmed])
+        candidate_regions = [cr for cr in crs if cr is not None]
         log.info("Found {0} candidate regions".format(len(candidate_regions)))
         return candidate_regions
 
@@ -489,7 +892,7 @@ class DungeonMap:
                  .format(to_string(polygon), connection))
 
         # See how much the polygon will be truncated by the existing map
-        trim_polygon = aagen.geometry.trim(polygon, self.conglomerate_polygon,
+        trim_polygon = aagen.geometry.trim(polygon, self.occupied_polygon,
                                            connection.polygon)
         if trim_polygon is not None:
             return self.make_candidate_region((0, 0), polygon, trim_polygon)
@@ -500,31 +903,69 @@ class DungeonMap:
 
     def make_candidate_region(self, offset, base_polygon, trim_polygon):
         """Construct a candidate region"""
-        conn_set = set()
-        for connection in self.get_incomplete_connections():
-            if connection.polygon.intersects(trim_polygon):
-                conn_set.add(connection)
-        amount_truncated = base_polygon.area - trim_polygon.area
-        log.debug("amount_truncated: {0}".format(amount_truncated))
-        wall_delta = (self.conglomerate_polygon.length -
-                      self.conglomerate_polygon.union(trim_polygon).length)
-        log.debug("base length: {0} trim length: {1} combined length: {2} "
-                  "wall_delta: {3}"
-                  .format(self.conglomerate_polygon.length,
-                          trim_polygon.length,
-                          self.conglomerate_polygon.union(trim_polygon).length,
-                          wall_delta))
-        log.debug("polygon: {0}\nconglomerate: {1}"
-                  .format(to_string(trim_polygon),
-                          to_string(self.conglomerate_polygon)))
-        shared_walls = (trim_polygon.length + wall_delta) / 2
-        if shared_walls < 5:
-            log.info("Candidate only shares {0}' of walls - not valid!"
-                     .format(shared_walls))
-            return None
+        return self.make_candidate_regions([offset], [base_polygon],
+                                           [trim_polygon])[0]
 
-        return Candidate_Region(offset, trim_polygon, conn_set,
-                                amount_truncated, shared_walls)
+
+    def make_candidate_regions(self, offsets, base_polygons, trim_polygons):
+        """Construct a candidate region for each of the given placements.
+        Returns a list containing a Candidate_Region object (or None if not
+        valid) for each placement."""
+        if not trim_polygons:
+            return []
+        # Work out what the placements have in common just once
+        incomplete = self.get_incomplete_connections()
+        base_length = self.conglomerate_polygon.length
+
+        candidates = []
+        for (offset, base_polygon, trim_polygon) in zip(offsets, base_polygons,
+                                                        trim_polygons):
+            conn_set = set(connection for connection in incomplete
+                           if trim_polygon.intersects(connection.polygon))
+            amount_truncated = base_polygon.area - trim_polygon.area
+            log.debug("amount_truncated: {0}".format(amount_truncated))
+            trim_length = trim_polygon.length
+            combined_length = self.conglomerate_polygon.union(
+                trim_polygon).length
+            wall_delta = base_length - combined_length
+            log.debug("base length: {0} trim length: {1} combined length: {2} "
+                      "wall_delta: {3}"
+                      .format(base_length, trim_length, combined_length,
+                              wall_delta))
+            shared_walls = (trim_length + wall_delta) / 2
+            if shared_walls < 5:
+                log.info("Candidate only shares {0}' of walls - not valid!"
+                         .format(shared_walls))
+                candidates.append(None)
+                continue
+            candidates.append(Candidate_Region(offset, trim_polygon,
+                                               conn_set, amount_truncated,
+                                               shared_walls))
+        return candidates
+
+
+    def free_distance(self, base_line, direction, max_distance,
+                      fixup_polygon=None):
+        """Cast the given line along the given direction and find how far
+        (up to max_distance) it can be swept before running into the existing
+        map. If a fixup_polygon (such as the joint of a turning passage) is
+        given, it must also be clear of the map or the result is 0.
+
+        Returns an upper bound on the length of an untruncated sweep;
+        see aagen.geometry.sweep_clearance().
+        """
+        if self.occupied_polygon.is_empty:
+            return max_distance
+        if (fixup_polygon is not None and not fixup_polygon.is_empty and
+            aagen.geometry.intersect(fixup_polygon, self.occupied_polygon)
+            .area >= aagen.geometry.SLIVER_AREA):
+            return 0
+        distance = aagen.geometry.sweep_clearance(base_line, direction,
+                                                  max_distance,
+                                                  self.occupied_polygon)
+        log.debug("{0} can be swept {1}' to the {2}"
+                  .format(to_string(base_line), distance, direction))
+        return distance
 
 
     def construct_intersection(self, connection, base_dir, exit_dir_list,
@@ -560,8 +1001,8 @@ class DungeonMap:
             # Default helper function
             def exit_helper(exit_dir, exit_line, region):
                 # Don't construct a connection if it would enter mapped space.
-                if (self.conglomerate_polygon.boundary.contains(exit_line) or
-                    self.conglomerate_polygon.boundary.overlaps(exit_line)):
+                if (self.occupied_polygon.boundary.contains(exit_line) or
+                    self.occupied_polygon.boundary.overlaps(exit_line)):
                     return None
                 return Connection(Connection.OPEN, exit_line, region,
                                   exit_dir)
@@ -597,19 +1038,37 @@ class DungeonMap:
 class MapElement(object):
     """Abstract parent class for any object placed onto the DungeonMap"""
 
+    # IDs for MapElements created while no DungeonMap is active
     _ids = count(0)
 
     def __init__(self, polygon):
-        self.id = self._ids.next()
+        self.id = new_element_id()
         self.polygon = aagen.geometry.polygon(polygon)
         self.tentative = True
 
 
+    @property
+    def polygon(self):
+        return self._polygon
+
+
+    @polygon.setter
+    def polygon(self, polygon):
+        self._polygon = polygon
+        # Shapely recomputes bounds on every access, so we cache them here
+        self._bounds = None
+
+
+    @property
+    def bounds(self):
+        if self._bounds is None:
+            self._bounds = self._polygon.bounds
+        return self._bounds
+
+
     def __getattr__(self, name):
         if name == "coords":
             return self.polygon.exterior.coords
-        elif name == "bounds":
-            return self.polygon.bounds
         raise AttributeError("'{0}' object has no attribute '{1}'"
                              .format(self.__class__, name))
 
@@ -636,7 +1095,8 @@ class Candidate_Region(MapElement):
         # How much wall length is shared with the existing dungeon?
         self.shared_walls = shared
 
-        log.debug("Constructed {0}".format(self))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Constructed {0}".format(self))
 
 
     def __repr__(self):
@@ -669,7 +1129,8 @@ class Region(MapElement):
         self.connections = SortedSet()
         self.decorations = SortedSet()
 
-        log.info("Constructed {0}".format(self))
+        if log.isEnabledFor(logging.INFO):
+            log.info("Constructed {0}".format(self))
 
 
     def __repr__(self):
@@ -715,7 +1176,8 @@ class Region(MapElement):
         #                       .format(connection, self))
         if not connection in self.connections:
             self.connections.add(connection)
-            log.info("Added ({0}) to ({1})".format(connection, self))
+            if log.isEnabledFor(logging.INFO):
+                log.info("Added ({0}) to ({1})".format(connection, self))
             connection.add_region(self)
 
 
@@ -745,7 +1207,8 @@ class CandidateConnection(MapElement):
         self.dir = dir
         self.region = parent_region
 
-        log.debug("Constructed {0}".format(self))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Constructed {0}".format(self))
 
     def __repr__(self):
         return ("<CandidateConnection {0}: line {1}, poly {2}, dir {3}>"
@@ -773,8 +1236,11 @@ class Connection(MapElement):
     ARCH = "Arch"
     __kinds = [OPEN, DOOR, SECRET, ONEWAY, ARCH]
 
-    def __init__(self, kind, line_coords, regions=None, dir=None):
-        """Construct a Connection along the given edge"""
+    def __init__(self, kind, line_coords, regions=None, dir=None,
+                 polygon=None):
+        """Construct a Connection along the given edge. If the Connection's
+        polygon is already known (e.g. from an earlier copy of the same
+        Connection), providing it saves having to work it out again."""
         assert kind in Connection.__kinds
         self.kind = kind
 
@@ -782,8 +1248,9 @@ class Connection(MapElement):
         line_coords = (self.line.coords[0], self.line.coords[-1])
         assert self.line.length > 0
 
-        log.info("Creating Connection ({kind}) along {line}"
-                 .format(kind=kind, line=to_string(self.line)))
+        if log.isEnabledFor(logging.INFO):
+            log.info("Creating Connection ({kind}) along {line}"
+                     .format(kind=kind, line=to_string(self.line)))
 
         self.direction = Direction.normal_to(line_coords)
         if dir is not None:
@@ -795,19 +1262,23 @@ class Connection(MapElement):
                             .format(self.direction, dir,
                                     self.direction.angle_from(dir)))
 
-        # TODO remove this?
-        (poly1, _) = aagen.geometry.sweep(self.line, self.direction, 10)
-        assert poly1.is_valid
-        (poly2, _) = aagen.geometry.sweep(self.line, self.direction.rotate(-45),
-                                          10)
-        (poly3, _) = aagen.geometry.sweep(self.line, self.direction.rotate(45),
-                                          10)
-        if poly2.is_valid and poly2.area > 0:
-            poly1 = poly1.intersection(poly2).convex_hull
-        if poly3.is_valid and poly3.area > 0:
-            poly1 = poly1.intersection(poly3).convex_hull
-        super(Connection, self).__init__(poly1)
-        log.info("Connection polygon is {0}".format(to_string(self.polygon)))
+        if polygon is None:
+            # TODO remove this?
+            (poly1, _) = aagen.geometry.sweep(self.line, self.direction, 10)
+            assert not aagen.geometry.validating() or poly1.is_valid
+            (poly2, _) = aagen.geometry.sweep(self.line,
+                                              self.direction.rotate(-45), 10)
+            (poly3, _) = aagen.geometry.sweep(self.line,
+                                              self.direction.rotate(45), 10)
+            if poly2.is_valid and poly2.area > 0:
+                poly1 = poly1.intersection(poly2).convex_hull
+            if poly3.is_valid and poly3.area > 0:
+                poly1 = poly1.intersection(poly3).convex_hull
+            polygon = poly1
+        super(Connection, self).__init__(polygon)
+        if log.isEnabledFor(logging.INFO):
+            log.info("Connection polygon is {0}"
+                     .format(to_string(self.polygon)))
 
         self.regions = SortedSet()
         if regions is not None:
@@ -822,15 +1293,28 @@ class Connection(MapElement):
 
         self.set_kind(kind)
 
-        log.debug("Constructed {0}".format(self))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Constructed {0}".format(self))
         return
 
 
     def set_kind(self, kind):
         assert kind in Connection.__kinds
         self.kind = kind
+        # The helper polygons for drawing are only worked out when needed
+        self._draw_lines = None
+
+
+    @property
+    def draw_lines(self):
+        if self._draw_lines is None:
+            self._draw_lines = self.get_draw_lines()
+        return self._draw_lines
+
 
-        # Add helper polygons for drawing
+    def get_draw_lines(self):
+        """Construct the helper polygons used to draw this Connection"""
+        kind = self.kind
         start = self.line.boundary[0]
         mid = self.line.interpolate(self.line.length / 2)
         mid1 = self.line.interpolate(2)
@@ -840,18 +1324,18 @@ class Connection(MapElement):
         left = sub_line.parallel_offset(1.5, 'left')
         right = sub_line.parallel_offset(1.5, 'right')
         if kind == Connection.DOOR:
-            self.draw_lines = [self.line,
-                               aagen.geometry.line_loop(list(left.coords) +
-                                                        list(right.coords))]
+            return [self.line,
+                    aagen.geometry.line_loop(list(left.coords) +
+                                             list(right.coords))]
         elif kind == Connection.ARCH:
-            self.draw_lines = [aagen.geometry.line(start, mid1),
-                               aagen.geometry.line(mid2, end),
-                               aagen.geometry.line(left.boundary[0],
-                                                   right.boundary[1]),
-                               aagen.geometry.line(left.boundary[1],
-                                                   right.boundary[0])]
+            return [aagen.geometry.line(start, mid1),
+                    aagen.geometry.line(mid2, end),
+                    aagen.geometry.line(left.boundary[0],
+                                        right.boundary[1]),
+                    aagen.geometry.line(left.boundary[1],
+                                        right.boundary[0])]
         elif kind == Connection.OPEN:
-            self.draw_lines = []
+            return []
         elif kind == Connection.ONEWAY:
             (door_poly, _) = aagen.geometry.sweep(sub_line,
                                                   self.direction.rotate(180),
@@ -867,9 +1351,9 @@ class Connection(MapElement):
             arrow_line2 = aagen.geometry.point_sweep(arrow_point,
                                                      self.direction.rotate(225),
                                                      arrowhead_len)
-            self.draw_lines = [self.line, door_ring,
-                               aagen.geometry.line(mid, arrow_point),
-                               arrow_line1, arrow_line2]
+            return [self.line, door_ring,
+                    aagen.geometry.line(mid, arrow_point),
+                    arrow_line1, arrow_line2]
         elif kind == Connection.SECRET:
             # Construct an "S" consisting of two 3/4 circles
             circle1 = (aagen.geometry.translate(mid, 2, 0)
@@ -884,7 +1368,7 @@ class Connection(MapElement):
             s  = aagen.geometry.line(list(reversed(arc1.coords)) +
                                      list(arc2.coords))
             s = aagen.geometry.rotate(s, self.direction)
-            self.draw_lines = [self.line, s]
+            return [self.line, s]
         else:
             raise LookupError("Don't know how to define draw_lines for {0}"
                               .format(kind))
@@ -946,8 +1430,9 @@ class Connection(MapElement):
             if len(self.regions) > 2:
                 # TODO throw an error?
                 log.warning("Too many regions for ({0})".format(self))
-            log.debug("Added Region ({0}) to Connection ({1})"
-                      .format(region, self))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Added Region ({0}) to Connection ({1})"
+                          .format(region, self))
             region.add_connection(self)
 
 
@@ -981,7 +1466,8 @@ class Decoration(MapElement):
 
         self.orientation = orientation
 
-        log.debug("Constructed {0}".format(self))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Constructed {0}".format(self))
 
 
     def __repr__(self):
@@ -0,0 +1,232 @@
+# aagen.raster - coarse raster (grid cell) representation of map geometry.
+#
+# Exact geometric operations (via Shapely) are comparatively expensive, so
+# for quick "broad phase" checks we also track the map as a grid of
+# CELL x CELL squares. Each row of the grid is stored as a Python integer
+# used as a bitset, so checking a candidate shape against the map costs a
+# handful of integer AND operations per row rather than a polygon boolean op.
+#
+# Only cells that lie *entirely* within a shape are marked, so any overlap
+# reported between two rasterized shapes is a guaranteed (lower bound) overlap
+# between the exact shapes as well.
+
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+CELL = 5
+
+
+def popcount(mask):
+    """Count the number of set bits in the given integer bitset"""
+    return bin(mask).count('1')
+
+
+def span_mask(lo, hi, offset):
+    """Construct a bitset with bits set for columns lo through hi (inclusive),
+    relative to the given column offset.
+    """
+    if hi < lo:
+        return 0
+    return ((1 << (hi - lo + 1)) - 1) << (lo - offset)
+
+
+def polygon_rings(geometry):
+    """Get the coordinate lists for all rings (exterior and interior)
+    of the given polygonal geometry.
+    """
+    if hasattr(geometry, "geoms"):
+        rings = []
+        for geom in geometry.geoms:
+            rings += polygon_rings(geom)
+        return rings
+    elif hasattr(geometry, "exterior"):
+        if geometry.is_empty:
+            return []
+        return ([list(geometry.exterior.coords)] +
+                [list(ring.coords) for ring in geometry.interiors])
+    # Points and lines have no area to rasterize
+    return []
+
+
+def rasterize(geometry, cell=CELL):
+    """Rasterize the given polygonal geometry onto the grid.
+
+    Returns the tuple (offset, rows) where rows is a dict mapping each row
+    index to a bitset of the cells in that row that lie entirely within the
+    geometry. Bit 0 of each bitset corresponds to column 'offset'.
+    Row j spans y from (j * cell) to ((j + 1) * cell), and likewise column i
+    spans x from (i * cell) to ((i + 1) * cell).
+    """
+    rings = polygon_rings(geometry)
+    if not rings:
+        return (0, {})
+
+    offset = int(math.floor(geometry.bounds[0] / cell))
+
+    # For each row, the x coordinates where the row's centerline crosses
+    # the geometry's boundary:
+    crossings = {}
+    # For each row, the cells whose interior is touched by the boundary:
+    boundary = {}
+
+    for coords in rings:
+        for ((x1, y1), (x2, y2)) in zip(coords[:-1], coords[1:]):
+            (ylo, yhi) = (min(y1, y2), max(y1, y2))
+            if y1 != y2:
+                # Half-open rule (ylo <= yc < yhi) so that vertices lying
+                # exactly on a centerline are only counted once
+                for j in range(int(math.ceil(ylo / cell - 0.5)),
+                               int(math.ceil(yhi / cell - 0.5))):
+                    yc = (j + 0.5) * cell
+                    crossings.setdefault(j, []).append(
+                        x1 + (yc - y1) * (x2 - x1) / (y2 - y1))
+
+            for j in range(int(math.floor(ylo / cell)),
+                           int(math.ceil(yhi / cell))):
+                if y1 == y2:
+                    (xa, xb) = (min(x1, x2), max(x1, x2))
+                else:
+                    ya = max(ylo, j * cell)
+                    yb = min(yhi, (j + 1) * cell)
+                    xa = x1 + (ya - y1) * (x2 - x1) / (y2 - y1)
+                    xb = x1 + (yb - y1) * (x2 - x1) / (y2 - y1)
+                    # Rounding error mustn't carry us past the segment's ends
+                    (xa, xb) = (max(min(xa, xb), min(x1, x2)),
+                                min(max(xa, xb), max(x1, x2)))
+                if xa == xb:
+                    if xa % cell == 0:
+                        # Runs along a grid line without entering any cell
+                        continue
+                    i_lo = i_hi = int(math.floor(xa / cell))
+                else:
+                    i_lo = int(math.floor(xa / cell))
+                    i_hi = int(math.ceil(xb / cell)) - 1
+                boundary[j] = (boundary.get(j, 0) |
+                               span_mask(i_lo, i_hi, offset))
+
+    rows = {}
+    for (j, xs) in crossings.items():
+        xs.sort()
+        mask = 0
+        for k in range(0, len(xs) - 1, 2):
+            mask |= span_mask(int(math.ceil(xs[k] / cell - 0.5)),
+                              int(math.floor(xs[k + 1] / cell - 0.5)),
+                              offset)
+        mask &= ~boundary.get(j, 0)
+        if mask:
+            rows[j] = mask
+
+    return (offset, rows)
+
+
+def cells(rows, offset):
+    """Get the sorted list of (column, row) indices of all cells set in the
+    given rasterized rows (as returned by rasterize()).
+    """
+    result = []
+    for j in sorted(rows.keys()):
+        mask = rows[j]
+        i = offset
+        while mask:
+            if mask & 1:
+                result.append((i, j))
+            mask >>= 1
+            i += 1
+    return sorted(result)
+
+
+def halo(offset, rows):
+    """Get the cells that are orthogonally adjacent to, but not part of,
+    the given rasterized shape. Returns (offset, rows) like rasterize().
+    """
+    # Shift everything one column over to make room for the new
+    # leftmost column of cells
+    grown = {}
+    for (j, mask) in rows.items():
+        mask <<= 1
+        for (k, neighbors) in [(j, (mask << 1) | (mask >> 1)),
+                               (j - 1, mask),
+                               (j + 1, mask)]:
+            grown[k] = grown.get(k, 0) | neighbors
+    result = {}
+    for (j, mask) in grown.items():
+        mask &= ~(rows.get(j, 0) << 1)
+        if mask:
+            result[j] = mask
+    return (offset - 1, result)
+
+
+class OccupancyGrid:
+    """Tracks which grid cells are known to be occupied by map geometry."""
+
+    def __init__(self, cell=CELL):
+        self.cell = cell
+        self.offset = 0
+        self.rows = {}
+
+
+    def __repr__(self):
+        return ("<OccupancyGrid: {0} cells occupied in {1} rows>"
+                .format(sum(popcount(m) for m in self.rows.values()),
+                        len(self.rows)))
+
+
+    def clear(self):
+        self.offset = 0
+        self.rows = {}
+
+
+    def add(self, geometry):
+        """Mark the cells covered by the given geometry as occupied"""
+        (offset, rows) = rasterize(geometry, self.cell)
+        if not rows:
+            return
+        if not self.rows:
+            self.offset = offset
+        elif offset < self.offset:
+            # Rebase the existing rows so all bit indices remain positive
+            shift = self.offset - offset
+            for j in self.rows:
+                self.rows[j] <<= shift
+            self.offset = offset
+        shift = offset - self.offset
+        for (j, mask) in rows.items():
+            self.rows[j] = self.rows.get(j, 0) | (mask << shift)
+
+
+    def overlap_count(self, offset, rows, dcol=0, drow=0):
+        """Count the occupied cells overlapped by the given rasterized
+        shape (as returned by rasterize()) after shifting it by the given
+        number of columns and rows.
+        """
+        shift = offset + dcol - self.offset
+        count = 0
+        for (j, mask) in rows.items():
+            occupied = self.rows.get(j + drow, 0)
+            if not occupied:
+                continue
+            if shift >= 0:
+                count += popcount(occupied & (mask << shift))
+            else:
+                count += popcount((occupied << -shift) & mask)
+        return count
+
+
+    def overlap_area(self, geometry):
+        """Returns a lower bound on the area of overlap between the given
+        geometry and the occupied space.
+        """
+        (offset, rows) = rasterize(geometry, self.cell)
+        count = self.overlap_count(offset, rows)
+        log.debug("Raster overlap: {0} cells".format(count))
+        return count * self.cell * self.cell
+
+
+    def overlaps(self, geometry):
+        """Returns True if the given geometry definitely overlaps (with
+        nonzero area) the occupied space. A False return value does not
+        guarantee that there is no overlap.
+        """
+        return self.overlap_area(geometry) > 0
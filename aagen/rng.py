@@ -0,0 +1,106 @@
+# aagen.rng - counter-based random number streams.
+#
+# An ordinary random number generator is a single sequence: every number it
+# produces depends on how many numbers were drawn before it. A counter-based
+# generator instead computes the n-th number of a stream directly from
+# (key, n), so any number of independent streams can be derived from a seed
+# and drawn from in any order without affecting one another. We use the
+# Philox4x64-10 function from Salmon et al., "Parallel Random Numbers: As Easy
+# as 1, 2, 3" (the same algorithm as numpy.random.Philox).
+
+import hashlib
+import random
+
+MASK64 = (1 << 64) - 1
+
+PHILOX_M0 = 0xD2E7470EE14C6C93
+PHILOX_M1 = 0xCA5A826395121157
+PHILOX_W0 = 0x9E3779B97F4A7C15
+PHILOX_W1 = 0xBB67AE8584CAA73B
+PHILOX_ROUNDS = 10
+
+
+def philox4x64(counter, key):
+    """Compute the Philox4x64-10 function of the given 256-bit counter
+    (as four 64-bit integers) and 128-bit key (as two 64-bit integers).
+    Returns four 64-bit random integers.
+    """
+    (c0, c1, c2, c3) = counter
+    (k0, k1) = key
+    for i in range(PHILOX_ROUNDS):
+        if i > 0:
+            k0 = (k0 + PHILOX_W0) & MASK64
+            k1 = (k1 + PHILOX_W1) & MASK64
+        product0 = PHILOX_M0 * c0
+        product1 = PHILOX_M1 * c2
+        (c0, c1, c2, c3) = ((product1 >> 64) ^ c1 ^ k0,
+                            product1 & MASK64,
+                            (product0 >> 64) ^ c3 ^ k1,
+                            product0 & MASK64)
+    return (c0, c1, c2, c3)
+
+
+def stream_key(*key):
+    """Derive a 128-bit Philox key from the given tuple of integers and
+    strings, such as (seed, "expand", connection_id, attempt).
+    """
+    digest = hashlib.sha256(repr(key).encode('ascii')).hexdigest()
+    return (int(digest[0:16], 16), int(digest[16:32], 16))
+
+
+class CounterRandom(random.Random):
+    """A random.Random whose numbers come from the Philox stream identified
+    by the given key, for example CounterRandom(seed, "expand", 12, 0).
+
+    Two instances with the same key always produce the same numbers, no
+    matter what other streams have been drawn from in the meantime.
+    """
+
+    def __new__(cls, *key):
+        # The underlying type would otherwise try to use the key as a seed
+        return random.Random.__new__(cls)
+
+
+    def __init__(self, *key):
+        self.key = stream_key(*key)
+        self.counter = 0
+        self.buffer = []
+        random.Random.__init__(self, 0)
+
+
+    def seed(self, *args, **kwargs):
+        """Reset the stream to its beginning. (The stream is determined by
+        its key, so any seed argument is ignored.)"""
+        self.counter = 0
+        self.buffer = []
+
+
+    def next64(self):
+        """Get the next 64-bit integer in the stream"""
+        if not self.buffer:
+            self.counter += 1
+            counter = (self.counter & MASK64, self.counter >> 64, 0, 0)
+            self.buffer = list(reversed(philox4x64(counter, self.key)))
+        return self.buffer.pop()
+
+
+    def random(self):
+        """Get the next float in the stream, in the range [0.0, 1.0)"""
+        return (self.next64() >> 11) * (1.0 / (1 << 53))
+
+
+    def getrandbits(self, k):
+        """Get an integer with k random bits"""
+        bits = 0
+        for shift in range(0, k, 64):
+            bits |= self.next64() << shift
+        return bits & ((1 << k) - 1)
+
+
+    def getstate(self):
+        return (self.key, self.counter, tuple(self.buffer))
+
+
+    def setstate(self, state):
+        (self.key, self.counter, buffer) = state
+        self.buffer = list(buffer)
@@ -0,0 +1,244 @@
+# aagen.scheduler - policies for which part of the dungeon to grow next.
+#
+# Each step of the generator expands one of the map's incomplete connections
+# (its "frontier"). Picking that connection uniformly at random lets the
+# dungeon sprawl in every direction at once; the other policies here instead
+# keep a priority queue of the frontier, so that the dungeon grows outward
+# from the entrance in a more compact way. Compact dungeons are also cheaper
+# to generate, since most geometry operations scale with the size and
+# complexity of the map outline.
+#
+# Connections that have already been expanded (but are still incomplete)
+# always rank behind those that haven't been expanded as often, so that a
+# connection that can't be expanded doesn't monopolize the generator.
+
+import heapq
+import math
+
+import aagen.geometry
+
+SCHEDULE_RANDOM = "random"
+SCHEDULE_BREADTH = "breadth"
+SCHEDULE_NEAREST = "nearest"
+SCHEDULE_DENSITY = "density"
+SCHEDULE_OLDEST = "oldest"
+SCHEDULE_WEIGHTED = "weighted"
+SCHEDULE_MODES = [SCHEDULE_RANDOM, SCHEDULE_BREADTH, SCHEDULE_NEAREST,
+                  SCHEDULE_DENSITY, SCHEDULE_OLDEST, SCHEDULE_WEIGHTED]
+
+DENSITY_RADIUS = 50
+"""Distance (in feet) around a connection within which to measure how much
+of the space is already occupied by the dungeon"""
+
+WEIGHT_DISTANCE = 100
+"""Distance (in feet) from the entrance at which a connection is half as
+likely to be chosen by the weighted random policy as one at the entrance"""
+
+
+def make_scheduler(schedule):
+    """Construct a new scheduler for the given policy name"""
+    if not schedule in SCHEDULES:
+        raise ValueError("Unknown schedule '{0}'".format(schedule))
+    return SCHEDULES[schedule]()
+
+
+def distance_from_origin(connection):
+    """Distance from the map origin (at the entrance) to the given
+    connection's midpoint"""
+    (xmin, ymin, xmax, ymax) = connection.line.bounds
+    return math.hypot((xmin + xmax) / 2.0, (ymin + ymax) / 2.0)
+
+
+class Scheduler(object):
+    """Picks incomplete connections uniformly at random. Subclasses instead
+    pick them in order of priority."""
+
+    def choose(self, generator, options):
+        """Choose the connection to expand next from the given list of
+        the map's incomplete connections"""
+        return generator.random.choice(options)
+
+
+    def ranked(self, generator, options):
+        """Iterate over the given incomplete connections in the order in which
+        they should be expanded"""
+        options = list(options)
+        generator.random.shuffle(options)
+        return iter(options)
+
+
+class PriorityScheduler(Scheduler):
+    """Abstract scheduler that picks the connection with the lowest value of
+    priority() first, with ties going to the oldest connection.
+
+    If a connection's priority can only increase over time, the subclass
+    can set dynamic = True to have it recalculated when it reaches the front
+    of the queue, rather than having to recalculate every priority each step.
+    """
+
+    dynamic = False
+
+    def __init__(self):
+        self.heap = []
+        # IDs of the connections that are currently in the heap
+        self.queued = set()
+
+
+    def priority(self, connection, generator):
+        raise NotImplementedError
+
+
+    def update(self, generator, options):
+        """Add any newly incomplete connections to the queue"""
+        for connection in options:
+            if connection.id not in self.queued:
+                self.queued.add(connection.id)
+                heapq.heappush(self.heap,
+                               (generator.expansions.get(connection.id, 0),
+                                self.priority(connection, generator),
+                                connection.id, connection))
+
+
+    def pop(self, generator):
+        """Remove and return the highest-priority connection that is still
+        incomplete, or None if there is none"""
+        dungeon_map = generator.dungeon_map
+        while self.heap:
+            (attempts, priority, conn_id, connection) = heapq.heappop(
+                self.heap)
+            self.queued.discard(conn_id)
+            if (connection not in dungeon_map.connections or
+                    not connection.is_incomplete()):
+                continue
+            # The connection may have been expanded (e.g., when the user
+            # chose it specifically) or grown more crowded since it was queued
+            current_attempts = generator.expansions.get(conn_id, 0)
+            current = priority
+            if self.dynamic:
+                current = self.priority(connection, generator)
+            if (current_attempts, current) != (attempts, priority):
+                self.queued.add(conn_id)
+                heapq.heappush(self.heap, (current_attempts, current,
+                                           conn_id, connection))
+                continue
+            return connection
+        return None
+
+
+    def choose(self, generator, options):
+        return next(self.ranked(generator, options))
+
+
+    def ranked(self, generator, options):
+        # Connections that are popped but not expanded will be queued
+        # again by the next call to update()
+        self.update(generator, options)
+        while True:
+            connection = self.pop(generator)
+            if connection is None:
+                return
+            yield connection
+
+
+class BreadthFirstScheduler(PriorityScheduler):
+    """Expands connections in order of how many regions away from the
+    entrance they are"""
+
+    def __init__(self):
+        super(BreadthFirstScheduler, self).__init__()
+        # Distance of each region (by ID) from the entrance, in regions
+        self.depths = {}
+        # Number of regions in the map when the depths were last computed
+        self.region_count = 0
+
+
+    def update(self, generator, options):
+        regions = generator.dungeon_map.regions
+        if len(regions) != self.region_count:
+            # New regions may also have opened shorter routes to old ones,
+            # so measure everything again and requeue with the new depths
+            self.depths = region_depths(regions)
+            self.region_count = len(regions)
+            self.heap = []
+            self.queued = set()
+        super(BreadthFirstScheduler, self).update(generator, options)
+
+
+    def priority(self, connection, generator):
+        return min(self.depths.get(region.id, float('inf'))
+                   for region in connection.regions)
+
+
+def region_depths(regions):
+    """Breadth-first search of the given regions from the entrance (the
+    first region generated). Returns a dict of each reachable region's
+    distance from the entrance, in regions, by region ID.
+    """
+    regions = list(regions)
+    if not regions:
+        return {}
+    depths = {regions[0].id: 0}
+    queue = [regions[0]]
+    for region in queue:
+        for conn in region.connections:
+            for other in conn.regions:
+                if other.id not in depths:
+                    depths[other.id] = depths[region.id] + 1
+                    queue.append(other)
+    return depths
+
+
+class NearestScheduler(PriorityScheduler):
+    """Expands the connection closest to the entrance first"""
+
+    def priority(self, connection, generator):
+        return distance_from_origin(connection)
+
+
+class DensityScheduler(PriorityScheduler):
+    """Expands the connection with the least of its surroundings already
+    occupied first"""
+
+    # Growth of the map can only increase a connection's local density
+    dynamic = True
+
+    def priority(self, connection, generator):
+        (xmin, ymin, xmax, ymax) = connection.line.bounds
+        area = aagen.geometry.box(xmin - DENSITY_RADIUS, ymin - DENSITY_RADIUS,
+                                  xmax + DENSITY_RADIUS, ymax + DENSITY_RADIUS)
+        return generator.dungeon_map.occupancy.overlap_area(area) / area.area
+
+
+class OldestScheduler(PriorityScheduler):
+    """Expands connections in the order they were created"""
+
+    def priority(self, connection, generator):
+        return 0
+
+
+class WeightedScheduler(PriorityScheduler):
+    """Picks connections at random, but favoring those closer to the
+    entrance. (Each step's random draws are made as the connections are
+    queued, so the queue is rebuilt each time.)"""
+
+    def update(self, generator, options):
+        self.heap = []
+        self.queued = set()
+        super(WeightedScheduler, self).update(generator, options)
+
+
+    def priority(self, connection, generator):
+        # Weighted sampling without replacement (Efraimidis and Spirakis):
+        # the highest random() ** (1 / weight) wins
+        weight = 1.0 / (1 + distance_from_origin(connection) / WEIGHT_DISTANCE)
+        return -(generator.random.random() ** (1.0 / weight))
+
+
+SCHEDULES = {
+    SCHEDULE_RANDOM: Scheduler,
+    SCHEDULE_BREADTH: BreadthFirstScheduler,
+    SCHEDULE_NEAREST: NearestScheduler,
+    SCHEDULE_DENSITY: DensityScheduler,
+    SCHEDULE_OLDEST: OldestScheduler,
+    SCHEDULE_WEIGHTED: WeightedScheduler,
+}
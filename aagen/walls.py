@@ -0,0 +1,171 @@
+# aagen.walls - index of the free wall space around a region.
+#
+# Placing an exit from a region means finding a stretch of its wall that
+# isn't already occupied by a connection and doesn't back onto another region.
+# Testing each candidate segment against every connection and every region
+# with Shapely gets expensive as the map grows, so instead we record, for each
+# horizontal or vertical line that the region's walls lie along, the 1-D
+# intervals along that line that are blocked. Checking a grid-aligned segment
+# then costs a few comparisons against a sorted list of intervals.
+
+import logging
+
+import aagen.geometry
+from aagen.geometry import to_string
+
+log = logging.getLogger(__name__)
+
+
+def span_key(coords):
+    """Get the (key, lo, hi) describing the given two-point line segment as an
+    interval along a horizontal or vertical line, where key is ('x', x) for a
+    vertical line or ('y', y) for a horizontal one.
+    Returns None if the segment is neither horizontal nor vertical.
+    """
+    ((x1, y1), (x2, y2)) = coords
+    if x1 == x2 and y1 != y2:
+        return (('x', x1), min(y1, y2), max(y1, y2))
+    elif y1 == y2 and x1 != x2:
+        return (('y', y1), min(x1, x2), max(x1, x2))
+    return None
+
+
+def merge_spans(spans):
+    """Merge the given list of (lo, hi) intervals into a sorted list of
+    disjoint intervals.
+    """
+    merged = []
+    for (lo, hi) in sorted(spans):
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def spans_overlap(spans, lo, hi):
+    """Check whether the interval (lo, hi) overlaps (by a nonzero length)
+    any of the given sorted, disjoint intervals.
+    """
+    for (span_lo, span_hi) in spans:
+        if span_lo >= hi:
+            break
+        if span_hi > lo:
+            return True
+    return False
+
+
+class WallIndex:
+    """Tracks which parts of a region's walls are blocked by its connections
+    or by other regions.
+
+    The index is a snapshot - it must be discarded whenever the region, its
+    connections, or the surrounding regions change.
+    """
+
+    def __init__(self, region, regions):
+        self.region = region
+        self.bounds = region.bounds
+        # Only the walls within these bounds are ever checked, so only
+        # regions touching them can block anything
+        (xmin, ymin, xmax, ymax) = self.bounds
+        self.others = [r for r in regions if r != region and
+                       r.bounds[0] <= xmax and r.bounds[2] >= xmin and
+                       r.bounds[1] <= ymax and r.bounds[3] >= ymin]
+
+        self.conn_spans = {}
+        for conn in region.connections:
+            coords = list(conn.line.coords)
+            for pair in zip(coords[:-1], coords[1:]):
+                span = span_key(pair)
+                if span is not None:
+                    (key, lo, hi) = span
+                    self.conn_spans.setdefault(key, []).append((lo, hi))
+        for key in self.conn_spans:
+            self.conn_spans[key] = merge_spans(self.conn_spans[key])
+
+        # Computed on demand for each line that is actually queried
+        self.region_spans = {}
+
+
+    def __repr__(self):
+        return ("<WallIndex for {0}: {1} lines with connections, "
+                "{2} lines checked against {3} other regions>"
+                .format(self.region, len(self.conn_spans),
+                        len(self.region_spans), len(self.others)))
+
+
+    def blocked_by_regions(self, key):
+        """Get the sorted list of intervals along the given line (within the
+        extent of this region) that lie within some other region.
+        """
+        if key in self.region_spans:
+            return self.region_spans[key]
+        (xmin, ymin, xmax, ymax) = self.bounds
+        (axis, value) = key
+        if axis == 'x':
+            wall_line = aagen.geometry.line((value, ymin), (value, ymax))
+        else:
+            wall_line = aagen.geometry.line((xmin, value), (xmax, value))
+        (lxmin, lymin, lxmax, lymax) = wall_line.bounds
+
+        spans = []
+        for other in self.others:
+            (oxmin, oymin, oxmax, oymax) = other.bounds
+            if (oxmin > lxmax or oxmax < lxmin or
+                oymin > lymax or oymax < lymin):
+                continue
+            overlap = aagen.geometry.intersect(other.polygon, wall_line)
+            if overlap.length == 0:
+                continue
+            if hasattr(overlap, "geoms"):
+                pieces = overlap.geoms
+            else:
+                pieces = [overlap]
+            for piece in pieces:
+                if piece.length == 0:
+                    continue
+                (pxmin, pymin, pxmax, pymax) = piece.bounds
+                if axis == 'x':
+                    spans.append((pymin, pymax))
+                else:
+                    spans.append((pxmin, pxmax))
+
+        spans = merge_spans(spans)
+        log.debug("{0} is blocked by other regions along {1}"
+                  .format(to_string(wall_line), spans))
+        self.region_spans[key] = spans
+        return spans
+
+
+    def is_free(self, segment, new_only=True):
+        """Check whether the given wall segment is clear of this region's
+        connections and (if new_only is set) of all other regions.
+
+        Returns True or False, or None if the segment isn't a straight
+        horizontal or vertical line and therefore can't be checked using
+        the index.
+        """
+        coords = list(segment.coords)
+        if len(coords) != 2:
+            return None
+        span = span_key(coords)
+        if span is None:
+            return None
+        (key, lo, hi) = span
+        (xmin, ymin, xmax, ymax) = self.bounds
+        if key[0] == 'x':
+            inside = (xmin <= key[1] <= xmax and ymin <= lo and hi <= ymax)
+        else:
+            inside = (ymin <= key[1] <= ymax and xmin <= lo and hi <= xmax)
+        if not inside:
+            return None
+        if spans_overlap(self.conn_spans.get(key, []), lo, hi):
+            log.debug("{0} conflicts with an existing connection"
+                      .format(to_string(segment)))
+            return False
+        if new_only and spans_overlap(self.blocked_by_regions(key), lo, hi):
+            log.debug("{0} conflicts with an existing region"
+                      .format(to_string(segment)))
+            return False
+        return True
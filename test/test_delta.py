@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Unit tests for aagen.delta
+
+import json
+import unittest
+
+from aagen.aajson import MapEncoder
+from aagen.delta import StepDelta
+from aagen.generator import DungeonGenerator, Silenced
+from aagen.map import DungeonMap, parse_footprint
+
+
+def describe(dungeon_map):
+    """Describe the given map, including the IDs of each element and how
+    they are linked, so that two maps can be compared for equality"""
+    return (json.dumps(dungeon_map, cls=MapEncoder, sort_keys=True),
+            [(region.id, region.kind,
+              sorted(conn.id for conn in region.connections))
+             for region in dungeon_map.regions],
+            [(conn.id, conn.kind, sorted(region.id for region in conn.regions))
+             for conn in dungeon_map.connections])
+
+
+class TestStepDelta(unittest.TestCase):
+
+    def check_mirror(self, seed, steps, footprint=None):
+        """Follow a generator's deltas, sent through JSON, with a copy of
+        its map, which must match the original after every step"""
+        dungeon_map = DungeonMap(footprint=footprint)
+        mirror = DungeonMap(footprint=footprint)
+        with Silenced():
+            generator = DungeonGenerator(dungeon_map, seed)
+            for delta in generator.iter_steps(steps, initial=True):
+                obj = json.loads(json.dumps(delta.to_dict(), cls=MapEncoder))
+                copy = StepDelta.from_dict(obj)
+                self.assertEqual(json.dumps(copy.to_dict(), cls=MapEncoder,
+                                            sort_keys=True),
+                                 json.dumps(delta.to_dict(), cls=MapEncoder,
+                                            sort_keys=True))
+                copy.apply(mirror)
+                self.assertEqual(describe(mirror), describe(dungeon_map))
+
+
+    def test_mirror(self):
+        self.check_mirror(1, 15)
+
+
+    def test_mirror_with_resets(self):
+        # A small footprint fills up quickly, so the map is reset
+        self.check_mirror(3, 15, parse_footprint("60x60"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# Unit tests for aagen.frontier
+
+import json
+import unittest
+
+from aagen.aajson import MapEncoder
+from aagen.batch import generate
+from aagen.generator import RANDOMNESS_COUNTER, STOP_STEPS
+
+
+class TestFrontierExpander(unittest.TestCase):
+
+    def test_same_map_for_any_number_of_jobs(self):
+        results = []
+        for jobs in [1, 2]:
+            (dungeon_map, summary) = generate(2, steps=20,
+                                              randomness=RANDOMNESS_COUNTER,
+                                              frontier=3, jobs=jobs)
+            self.assertEqual(summary['reason'], STOP_STEPS)
+            results.append((json.dumps(dungeon_map, cls=MapEncoder,
+                                       sort_keys=True),
+                            summary['regions'], summary['degraded']))
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Unit tests for aagen.generator
+
+import json
+import unittest
+
+from aagen.aajson import MapEncoder
+from aagen.generator import (DungeonGenerator, Silenced, RANDOMNESS_COUNTER,
+                             STOP_ERROR, STOP_STEPS)
+from aagen.map import DungeonMap
+
+
+def make_generator(seed):
+    with Silenced():
+        return DungeonGenerator(DungeonMap(), seed,
+                                randomness=RANDOMNESS_COUNTER, reset=False)
+
+
+def describe(generator):
+    """Describe the generator's map and the counters that go with it"""
+    return (json.dumps(generator.dungeon_map, cls=MapEncoder,
+                       sort_keys=True),
+            generator.dungeon_map.next_element_id, generator.step_number,
+            sorted(generator.expansions.items()), generator.summary())
+
+
+class TestRun(unittest.TestCase):
+
+    def test_failed_step_is_rolled_back(self):
+        generator = make_generator(1)
+        reference = make_generator(1)
+        with Silenced():
+            for g in [generator, reference]:
+                self.assertEqual(g.run(steps=5)['reason'], STOP_STEPS)
+        before = describe(generator)
+
+        expand = generator.expand
+        def broken_expand(connection):
+            # Fail only after changing the map and the counters
+            expand(connection)
+            generator.degrade(connection, "broken")
+            raise RuntimeError("broken")
+        generator.expand = broken_expand
+        with Silenced():
+            result = generator.run(steps=1)
+        self.assertEqual(result['reason'], STOP_ERROR)
+        self.assertEqual(result['steps'], 0)
+        self.assertEqual(result['degraded'], 0)
+        self.assertTrue("RuntimeError: broken" in result['error'])
+        self.assertEqual(describe(generator), before)
+
+        # Carrying on gives the same dungeon as if the step had never failed
+        generator.expand = expand
+        with Silenced():
+            for g in [generator, reference]:
+                self.assertEqual(g.run(steps=3)['reason'], STOP_STEPS)
+        self.assertEqual(describe(generator), describe(reference))
+
+
+if __name__ == "__main__":
+    unittest.main()
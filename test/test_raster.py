@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Unit tests for aagen.raster
+
+import unittest
+
+from shapely.geometry import Polygon, box
+
+from aagen.raster import CELL, OccupancyGrid, rasterize
+
+
+class TestRasterize(unittest.TestCase):
+
+    def assert_cells_inside(self, polygon):
+        """Every cell reported by rasterize() must lie entirely within
+        the polygon, so that raster overlap is a lower bound on the exact
+        overlap.
+        """
+        (offset, rows) = rasterize(polygon)
+        for (j, mask) in rows.items():
+            for i in range(offset, offset + mask.bit_length()):
+                if not mask & (1 << (i - offset)):
+                    continue
+                square = box(i * CELL, j * CELL,
+                             (i + 1) * CELL, (j + 1) * CELL)
+                self.assertAlmostEqual(square.intersection(polygon).area,
+                                       CELL * CELL)
+
+
+    def test_box(self):
+        (offset, rows) = rasterize(box(-10, 0, 10, 10))
+        self.assertEqual(offset, -2)
+        self.assertEqual(rows, {0: 0b1111, 1: 0b1111})
+
+
+    def test_sloped_edge_on_cell_boundary(self):
+        # The interpolated x of the sloped edge could round to just left of
+        # x = 0, which is the grid offset, and raise "negative shift count"
+        for coords in [[(0, 1.6565), (12.0549, 17.566), (12.0549, 47.566)],
+                       [(0, 7.7311), (3.0665, 21.0459), (3.0665, 51.0459)],
+                       [(5, 2.3112), (20.1361, 8.3692), (20.1361, 38.3692)]]:
+            polygon = Polygon(coords)
+            self.assert_cells_inside(polygon)
+            grid = OccupancyGrid()
+            grid.add(polygon)
+            self.assertTrue(grid.overlap_area(polygon) <= polygon.area)
+
+
+    def test_overlap_lower_bound(self):
+        grid = OccupancyGrid()
+        occupied = Polygon([(0, 0), (40, 3), (37, 41), (-2, 30)])
+        grid.add(occupied)
+        for shape in [box(10, 10, 60, 20),
+                      Polygon([(-7, -3), (20, 15), (3, 44)]),
+                      box(12.5, 12.5, 17.5, 17.5)]:
+            self.assert_cells_inside(shape)
+            self.assertTrue(grid.overlap_area(shape) <=
+                            shape.intersection(occupied).area)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Unit tests for aagen.rng
+
+import unittest
+
+from aagen.rng import CounterRandom, philox4x64, stream_key
+
+try:
+    from numpy.random import Philox
+except ImportError:
+    # Philox is only in NumPy 1.17 and later, which needs Python 3
+    Philox = None
+
+
+# The first 8 outputs of numpy.random.Philox(key=k0 | (k1 << 64)), which
+# computes philox4x64() of counters (1, 0, 0, 0), (2, 0, 0, 0) and so on
+PHILOX_VECTORS = [
+    ((0, 0),
+     [0x02f4ba6408e4d89b, 0x3dd62b0b9ca8c5b2, 0x1c8667a55d902e79,
+      0x907d7a052fd5b4dc, 0x809bf322883987c3, 0x471128b9e807f7dd,
+      0xf250ba0dbec065b7, 0xfc6ed66767a457bc]),
+    ((0x0123456789abcdef, 0xfedcba9876543210),
+     [0x2d2e7c09c193c5fa, 0xd56c6aa2d11f06aa, 0x184fcdf7f5474a23,
+      0x367832d087008054, 0x56ffd4cf84d16286, 0x09fc1192f2145d80,
+      0x53d6554fb9aa0f62, 0x0c3f437f88182365]),
+]
+
+
+class TestPhilox(unittest.TestCase):
+
+    def test_known_answers(self):
+        for (key, expected) in PHILOX_VECTORS:
+            self.assertEqual(list(philox4x64((1, 0, 0, 0), key)) +
+                             list(philox4x64((2, 0, 0, 0), key)),
+                             expected)
+
+
+    @unittest.skipIf(Philox is None, "numpy.random.Philox not available")
+    def test_against_numpy(self):
+        for key in [(0, 0), (1, 2), stream_key(7, "expand", 12, 0)]:
+            expected = [int(x) for x in
+                        Philox(key=key[0] | (key[1] << 64)).random_raw(8)]
+            self.assertEqual(list(philox4x64((1, 0, 0, 0), key)) +
+                             list(philox4x64((2, 0, 0, 0), key)),
+                             expected)
+
+
+    def test_counter_random_stream(self):
+        rng = CounterRandom(7, "expand", 12, 0)
+        key = stream_key(7, "expand", 12, 0)
+        self.assertEqual([rng.next64() for _ in range(8)],
+                         list(philox4x64((1, 0, 0, 0), key)) +
+                         list(philox4x64((2, 0, 0, 0), key)))
+        # Streams don't depend on each other or on how far they've been drawn
+        self.assertNotEqual(CounterRandom(7, "expand", 12, 1).random(),
+                            CounterRandom(7, "expand", 12, 0).random())
+        rng.seed()
+        self.assertEqual(rng.random(),
+                         CounterRandom(7, "expand", 12, 0).random())
+
+
+if __name__ == "__main__":
+    unittest.main()